@@ -0,0 +1,85 @@
+# python -m tests.benchmarks [spawn] [batch] [slugs] [hydrate] [lazy] [compact]
+# reproduces the figures quoted in the change log and the commits, run them all when no name is given
+
+from sys import argv
+from time import perf_counter
+import gc
+import tracemalloc
+
+import bson
+
+from yModel import set_slug_cache_size
+
+from tests import models
+
+def timed(function, *args, **kwargs):
+  start = perf_counter()
+  function(*args, **kwargs)
+  return perf_counter() - start
+
+def report(name, before, after, unit = "s"):
+  print("{}: {:.3f}{} -> {:.3f}{}".format(name, before, unit, after, unit))
+
+def spawn(times = 20000):
+  def build(factory):
+    for i in range(times):
+      factory()
+
+  report("DecoratorsSchema x {}".format(times), timed(build, models.DecoratorsSchema), timed(build, models.DecoratorsSchema.spawn))
+
+def load(model, rows, **kwargs):
+  model.load(rows, many = True, **kwargs)
+  return model
+
+def batch(rows = 100000):
+  with_slugs = [{"name": "Node {}".format(i), "path": "/", "slug": "node-{}".format(i)} for i in range(rows)]
+  without_slugs = [{"name": "Node {}".format(i), "path": "/"} for i in range(rows)]
+  for name, model, data in (("MinimalTree", models.MinimalTree, with_slugs), ("RealTree needing slugs", models.RealTree, without_slugs)):
+    marshmallow = model(many = True)
+    marshmallow.batch_load = False
+    report("{}, {} rows".format(name, rows), timed(load, marshmallow, [dict(row) for row in data]), timed(load, model(many = True), [dict(row) for row in data]))
+
+def slugs(rows = 100000, distinct = 500):
+  data = [{"name": "Node {}".format(i % distinct), "path": "/"} for i in range(rows)]
+  set_slug_cache_size(0)
+  before = timed(load, models.RealTree(many = True), [dict(row) for row in data])
+  set_slug_cache_size(4096)
+  report("{} rows, {} distinct names".format(rows, distinct), before, timed(load, models.RealTree(many = True), [dict(row) for row in data]))
+
+def tree_docs(rows, members = 0):
+  return [{"_id": bson.ObjectId(), "name": "Node {}".format(i), "path": "/", "slug": "node-{}".format(i), "members": [bson.ObjectId() for j in range(members)], "elements": []} for i in range(rows)]
+
+def hydrate(rows = 50000):
+  docs = tree_docs(rows, 5)
+  report("{} tree documents, load -> hydrate".format(rows), timed(load, models.RealMongoTree(many = True), docs), timed(models.RealMongoTree(many = True).hydrate, docs, many = True))
+
+def lazy(items = 200000):
+  doc = {"_id": bson.ObjectId(), "name": "Big", "path": "/", "slug": "big", "members": [], "elements": ["item-{}".format(i) for i in range(items)]}
+
+  def read(**kwargs):
+    model = models.RealMongoTree()
+    model.load(doc, **kwargs)
+    return model.name
+
+  report("one field of a document with a {} item list".format(items), timed(read) * 1000, timed(read, lazy = True) * 1000, "ms")
+
+def retained(rows, **kwargs):
+  docs = tree_docs(rows)
+  gc.collect()
+  tracemalloc.start()
+  model = load(models.MinimalMongoTree(many = True), docs, **kwargs)
+  del docs
+  gc.collect()
+  size = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  del model
+  return size / 1024 / 1024
+
+def compact(rows = 1000000):
+  report("{} MinimalMongoTree rows retained".format(rows), retained(rows), retained(rows, compact = True), "MB")
+
+benchmarks = {"spawn": spawn, "batch": batch, "slugs": slugs, "hydrate": hydrate, "lazy": lazy, "compact": compact}
+
+if __name__ == "__main__":
+  for name in argv[1:] or benchmarks:
+    benchmarks[name]()
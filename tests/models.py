@@ -27,6 +27,10 @@ class MinimalMongo(MongoSchema):
 class AnotherMongo(MinimalMongo):
   finished = fields.Bool()
 
+class Contact(MinimalMongo):
+  email = fields.Str(load_from = "emailAddress")
+  phone = fields.Str(attribute = "telephone")
+
 class MinimalMongoTree(MinimalMongo, MongoTree):
   path = fields.Str(required = True)
   slug = fields.Str(required = True)
@@ -41,6 +45,38 @@ class RealMongoTree(MinimalMongoTree):
 class User(MinimalMongoTree):
   pass
 
+class RankedTree(MinimalMongoTree):
+  type = fields.Str()
+  elements = fields.List(fields.Str)
+
+  order_strategy = "rank"
+  children_models = {"elements": "RankedTree"}
+
+class AggregatedTree(RealMongoTree):
+  size = fields.Int()
+
+  aggregates = True
+  aggregate_sums = ("size", )
+  children_models = {"members": "User", "elements": "AggregatedTree"}
+
+class BulkTree(RealMongoTree):
+  write_policy = "bulk"
+  children_models = {"members": "User", "elements": "BulkTree"}
+
+class Greeting(Schema):
+  name = fields.Str()
+  greeting = fields.Method("greet")
+
+  def greet(self, obj):
+    return "{} {}".format(self.context.get("greeting", "Hello"), obj["name"])
+
+class Stateful(Schema):
+  name = fields.Str()
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.seen = []
+
 class NameOnlyRequestSchema(Schema):
   name = fields.Str(required = True)
 
@@ -7,16 +7,21 @@ from decimal import Decimal
 from unittest import TestCase
 
 import bson
-from pymongo.errors import InvalidOperation
-from pymongo import MongoClient
+from pymongo.errors import InvalidOperation, PyMongoError
+from pymongo import MongoClient, ReadPreference
+from pymongo.read_preferences import SecondaryPreferred
+from pymongo.write_concern import WriteConcern
 from motor.motor_asyncio import AsyncIOMotorClient
 
 from marshmallow.exceptions import ValidationError
 
 from slugify import slugify
 
-from yModel.mongo import MongoJSONEncoder, NotFound
+from yModel.mongo import MongoJSONEncoder, NotFound, URIAlreadyExists, subtree_query, page_token, page_order, keyset_query, rank_between, ranks_between, restoring
 
+from asyncio import gather, sleep
+
+from yModel.cache import NodeCache, ChangeStreamInvalidator, MongoTokenStore
 from yModel.utils import AioTestCase
 
 from tests import models
@@ -47,6 +52,84 @@ class TestObjectIdErrors(TestCase):
     self.assertIn("_id", errors)
     self.assertEqual('invalid ObjectId `10`', errors["_id"][0])
 
+class TestPlainDict(TestCase):
+  def test(self):
+    model = models.MinimalMongo()
+    model.load({"_id": bson.ObjectId(), "name": "Plain dict"})
+    data = dict(model.get_data(), reward = bson.decimal128.Decimal128("100"), when = datetime.now(), tags = ("a", "b"), extra = {1: Decimal("1.5")})
+    model.__data__ = data
+
+    self.assertEqual(model.to_plain_dict(), loads(dumps(data, cls = MongoJSONEncoder)))
+    self.assertEqual(model.to_json(), dumps(data, cls = MongoJSONEncoder))
+
+  def testMany(self):
+    model = models.MinimalMongo(many = True)
+    model.load([{"_id": bson.ObjectId(), "name": "First"}, {"_id": bson.ObjectId(), "name": "Second"}], many = True)
+
+    self.assertEqual(model.to_plain_dict(["_id"]), [{"name": "First"}, {"name": "Second"}])
+    self.assertIn("_id", model.get_data()[0])
+
+class TestProjection(TestCase):
+  def test(self):
+    self.assertEqual(models.AnotherMongo().projection(), {"_id": 1, "name": 1, "finished": 1})
+    self.assertEqual(models.AnotherMongo(only = ("name", )).projection(), {"name": 1})
+    self.assertEqual(models.AnotherMongo(exclude = ("finished", )).resolve_projection(), {"_id": 1, "name": 1})
+
+  def testKeys(self):
+    self.assertEqual(models.Contact().projection(), {"_id": 1, "name": 1, "email": 1, "emailAddress": 1, "phone": 1, "telephone": 1})
+
+  def testOptOut(self):
+    self.assertIsNone(models.AnotherMongo().resolve_projection(False))
+    self.assertEqual(models.AnotherMongo().resolve_projection({"name": 1}), {"name": 1})
+
+class TestPageToken(TestCase):
+  def test(self):
+    doc = {"_id": bson.ObjectId(), "name": "Page token"}
+    token = page_token("name", doc)
+
+    self.assertEqual(keyset_query(token, "name"), {"$or": [{"name": {"$gt": "Page token"}}, {"name": "Page token", "_id": {"$gt": doc["_id"]}}]})
+    self.assertEqual(keyset_query(page_token("_id", doc), "_id", -1), {"_id": {"$lt": doc["_id"]}})
+
+  def testOrder(self):
+    self.assertEqual(page_order(None), ("_id", 1))
+    self.assertEqual(page_order(None, ("__order", 1)), ("__order", 1))
+    for sort in ("name", ("name", 1), [("name", 1)], [("name", 1), ("_id", 1)], {"name": 1}, {"$sort": {"name": 1, "_id": 1}}):
+      self.assertEqual(page_order(sort), ("name", 1))
+    self.assertEqual(page_order([("name", -1)]), ("name", -1))
+
+    with self.assertRaises(ValidationError):
+      page_order([("name", 1), ("age", 1)])
+
+    with self.assertRaises(ValidationError):
+      page_order([1])
+
+  def testNull(self):
+    doc = {"_id": bson.ObjectId()}
+    token = page_token("name", doc)
+
+    self.assertEqual(keyset_query(token, "name"), {"$or": [{"name": {"$ne": None}}, {"name": None, "_id": {"$gt": doc["_id"]}}]})
+    self.assertEqual(keyset_query(token, "name", -1), {"name": None, "_id": {"$lt": doc["_id"]}})
+    self.assertIn({"name": None}, keyset_query(page_token("name", {"_id": doc["_id"], "name": "Page token"}), "name", -1)["$or"])
+
+  def testInvalid(self):
+    with self.assertRaises(ValidationError):
+      keyset_query("not a token", "name")
+
+    with self.assertRaises(ValidationError):
+      keyset_query(page_token("_id", {"_id": bson.ObjectId()}), "name")
+
+class TestReadPreference(TestCase):
+  def test(self):
+    model = models.MinimalMongo(AsyncIOMotorClient(MONGO_URI).tests.tests)
+    self.assertIs(model.reader(), model.table)
+
+    model.read_preference = SecondaryPreferred(max_staleness = 90)
+    model.read_concern = "majority"
+    table = model.reader()
+    self.assertEqual(table.read_preference, SecondaryPreferred(max_staleness = 90))
+    self.assertEqual(table.read_concern.level, "majority")
+    self.assertEqual(model.reader(ReadPreference.PRIMARY).read_preference, ReadPreference.PRIMARY)
+
 class TestCreate(AioTestCase):
   def setUp(self):
     self.table = AsyncIOMotorClient(MONGO_URI).tests.tests
@@ -76,6 +159,25 @@ class TestCreate(AioTestCase):
 
     self.table.delete_one({"_id": model_data["_id"]})
 
+class TestCreateMany(AioTestCase):
+  def setUp(self):
+    self.table = AsyncIOMotorClient(MONGO_URI).tests.tests
+
+  async def testNoTable(self):
+    with self.assertRaises(InvalidOperation):
+      await models.MinimalMongo.create_many(None, [{"name": "Test create many no table"}])
+
+  async def test(self):
+    data = [{"name": "Test create many"}, {"name": 25}, {"name": "Test create many"}]
+    model, errors = await models.MinimalMongo.create_many(self.table, data, chunk_size = 1)
+    saved = await self.table.find({"name": "Test create many"}).to_list(None)
+
+    self.assertEqual(len(model.get_data()), 2)
+    self.assertEqual(list(errors.keys()), [1])
+    self.assertEqual(sorted(doc["_id"] for doc in saved), sorted(doc["_id"] for doc in model.get_data()))
+
+    await self.table.delete_many({"name": "Test create many"})
+
 class TestGet(AioTestCase):
   def setUp(self):
     self.table = AsyncIOMotorClient(MONGO_URI).tests.tests
@@ -105,6 +207,108 @@ class TestGet(AioTestCase):
 
     self.table.delete_one({"_id": modeldata["_id"]})
 
+  async def testProjection(self):
+    data = {"name": "Test get projection", "finished": True, "heavy": ["a"] * 1000}
+    result = await self.table.insert_one(data)
+
+    model = models.AnotherMongo(self.table, only = ("_id", "name"))
+    await model.get(_id = result.inserted_id)
+    raw = await self.table.find_one({"_id": result.inserted_id}, model.projection())
+
+    self.assertEqual(model.get_data(), {"_id": result.inserted_id, "name": data["name"]})
+    self.assertNotIn("heavy", raw)
+
+    await self.table.delete_one({"_id": result.inserted_id})
+
+  async def testTrusted(self):
+    data = {"name": "Test get trusted", "finished": True, "heavy": ["a"] * 10}
+    result = await self.table.insert_one(data)
+
+    model = models.AnotherMongo(self.table)
+    await model.get(_id = result.inserted_id, trusted = True, projection = False)
+    self.assertEqual(model.get_data(), {"_id": result.inserted_id, "name": data["name"], "finished": True})
+
+    await self.table.update_one({"_id": result.inserted_id}, {"$unset": {"name": 1}})
+    await model.get(_id = result.inserted_id, trusted = True)
+    self.assertEqual(model.get_errors(), {"name": ["Missing data for required field."]})
+
+    await self.table.delete_one({"_id": result.inserted_id})
+
+  async def testLazy(self):
+    data = {"name": "Test get lazy", "finished": True}
+    result = await self.table.insert_one(data)
+
+    model = models.AnotherMongo(self.table)
+    await model.get(_id = result.inserted_id, lazy = True)
+    self.assertEqual(model.name, data["name"])
+    self.assertNotIn("finished", model.__data__)
+
+    await model.update({"finished": False})
+    self.assertEqual(model.get_data(), {"_id": result.inserted_id, "name": data["name"], "finished": False})
+
+    await self.table.delete_one({"_id": result.inserted_id})
+
+  async def testPage(self):
+    docs = [{"name": "Test page"} for i in range(5)]
+    await self.table.insert_many(docs)
+
+    model = models.MinimalMongo(self.table)
+    pages = []
+    token = None
+    while True:
+      token = await model.page(query = {"name": "Test page"}, limit = 2, after = token)
+      pages.append([doc["_id"] for doc in model.get_data()])
+      if not token:
+        break
+
+    self.assertEqual(pages, [[doc["_id"] for doc in docs[i:i + 2]] for i in range(0, 5, 2)])
+
+    await self.table.delete_many({"name": "Test page"})
+
+  async def testProjectedKeys(self):
+    contact = models.Contact(self.table)
+    contact.load({"name": "Test contact", "emailAddress": "contact@example.com"}, partial = ("_id", ))
+    await contact.create()
+
+    model = models.Contact(self.table)
+    await model.get(_id = contact._id)
+    self.assertEqual(model.email, "contact@example.com")
+
+    await self.table.delete_one({"_id": contact._id})
+
+  async def testPageNullable(self):
+    docs = [{"name": "Test null page", "order": order} for order in (2, None, 1, None)] + [{"name": "Test null page"}]
+    await self.table.insert_many(docs)
+
+    model = models.MinimalMongo(self.table)
+    for direction in (1, -1):
+      ids = []
+      token = None
+      while True:
+        token = await model.page(query = {"name": "Test null page"}, limit = 2, after = token, sort = ("order", direction))
+        ids.extend(doc["_id"] for doc in model.get_data())
+        if not token:
+          break
+
+      expected = await self.table.find({"name": "Test null page"}).sort([("order", direction), ("_id", direction)]).to_list(None)
+      self.assertEqual(ids, [doc["_id"] for doc in expected])
+
+    await self.table.delete_many({"name": "Test null page"})
+
+  async def testStream(self):
+    docs = [{"name": "Test stream"} for i in range(5)]
+    await self.table.insert_many(docs)
+
+    model = models.MinimalMongo(self.table)
+    sizes = []
+    async for batch in model.stream(query = {"name": "Test stream"}, batch_size = 2):
+      sizes.append(len(batch.get_data()))
+      self.assertIsInstance(batch, models.MinimalMongo)
+
+    self.assertEqual(sizes, [2, 2, 1])
+
+    await self.table.delete_many({"name": "Test stream"})
+
 class TestUpdate(AioTestCase):
   def setUp(self):
     self.table = AsyncIOMotorClient(MONGO_URI).tests.tests
@@ -153,6 +357,31 @@ class TestUpdate(AioTestCase):
 
     await self.table.delete_one({"_id": data["_id"]})
 
+  async def testBulk(self):
+    result = await self.table.insert_many([{"name": "Test bulk update"}, {"name": "Test bulk update"}])
+    ids = result.inserted_ids
+
+    counts = await models.AnotherMongo.bulk_update(self.table, [
+      {"_id": ids[0], "finished": True},
+      ({"_id": ids[1]}, {"name": "Test bulk update edited", "finished": False})
+    ])
+    saved = await self.table.find({"_id": {"$in": ids}}).sort("_id").to_list(None)
+
+    self.assertEqual(counts, {"matched": 2, "modified": 2, "upserted": 0})
+    self.assertEqual([doc.get("finished") for doc in saved], [True, False])
+    self.assertEqual(saved[1]["name"], "Test bulk update edited")
+
+    with self.assertRaises(ValidationError):
+      await models.AnotherMongo.bulk_update(self.table, [{"_id": ids[0], "name": 25}])
+
+    with self.assertRaises(ValidationError) as context:
+      await models.AnotherMongo.bulk_update(self.table, [{"_id": ids[0], "finished": False}, {"finished": False}])
+
+    self.assertEqual(list(context.exception.messages), [1])
+    self.assertIn("_id", context.exception.messages[1])
+
+    await self.table.delete_many({"_id": {"$in": ids}})
+
 class TestRemoveField(AioTestCase):
   def setUp(self):
     self.table = AsyncIOMotorClient(MONGO_URI).tests.tests
@@ -268,6 +497,41 @@ class TestAncestors(AioTestCase):
     self.assertIsInstance(parent, models.MinimalMongoTree)
     self.assertEqual(parent.get_data()["_id"], self.papers[-2]["_id"])
 
+  async def testParentCheck(self):
+    model = models.MinimalMongoTree(self.table)
+    await model.get(_id = self.papers[-1]["_id"])
+    parent = await model.ancestors(models, True, lambda ancestor: ancestor.slug == "parent-1")
+
+    self.assertIsInstance(parent, models.MinimalMongoTree)
+    self.assertEqual(parent.get_data()["_id"], self.papers[0]["_id"])
+
+  async def testCache(self):
+    models.MinimalMongoTree.cache = NodeCache()
+    try:
+      model = models.MinimalMongoTree(self.table)
+      await model.get(_id = self.papers[-1]["_id"])
+      await model.ancestors(models)
+      ancestors = await model.ancestors(models)
+
+      self.assertEqual([ancestor._id for ancestor in ancestors], [paper["_id"] for paper in self.papers[:2]])
+      self.assertEqual(models.MinimalMongoTree.cache.stats()["hits"], 2)
+
+      await ancestors[-1].update({"name": "Renamed"}, models)
+
+      self.assertIsNone(models.MinimalMongoTree.cache.get(self.papers[1]["_id"]))
+    finally:
+      del models.MinimalMongoTree.cache
+
+  def testLevels(self):
+    model = models.MinimalMongoTree()
+    model.load({"path": "/parent-1/parent-2", "name": "Paper"})
+
+    self.assertEqual(model.ancestor_levels(), [
+      {"path": "/parent-1", "slug": "parent-2"},
+      {"path": "/", "slug": "parent-1"},
+      {"path": ""}
+    ])
+
 class TestChildren(AioTestCase):
   async def setUp(self):
     self.client = AsyncIOMotorClient(MONGO_URI)
@@ -319,6 +583,57 @@ class TestChildren(AioTestCase):
     for user in self.papers[3:5]:
       self.assertIn(user["_id"], ids)
 
+  async def testTrusted(self):
+    model = models.RealMongoTree(self.table)
+    await model.get(_id = self.papers[-1]["_id"], trusted = True)
+    children = await model.children("elements", models, trusted = True)
+    loaded = await model.children("elements", models)
+
+    self.assertEqual(children.get_data(), loaded.get_data())
+    self.assertIsNone(children.get_errors())
+
+  async def testCompact(self):
+    model = models.RealMongoTree(self.table)
+    await model.get(_id = self.papers[-1]["_id"])
+    children = await model.children("elements", models, compact = True)
+    loaded = await model.children("elements", models)
+
+    self.assertEqual(children.get_data(), loaded.get_data())
+    self.assertEqual(children.to_json(), loaded.to_json())
+
+  async def testContext(self):
+    model = models.RealMongoTree(self.table)
+    await model.get(_id = self.papers[-1]["_id"])
+    context = await model.load_context(models)
+
+    self.assertEqual(context["ancestors"], [])
+    self.assertIsNone(context["parent"])
+    self.assertEqual(list(context["children"].keys()), ["members", "elements"])
+    self.assertEqual(context["children"]["elements"].get_data(), (await model.children("elements", models)).get_data())
+    self.assertEqual(context["children"]["members"].get_data(), (await model.children("members", models)).get_data())
+
+    context = await model.load_context(models, members = ["elements"])
+    self.assertEqual(list(context["children"].keys()), ["elements"])
+
+  async def testPage(self):
+    model = models.RealMongoTree(self.table)
+    await model.get(_id = self.papers[-1]["_id"])
+    first, token = await model.children_page("elements", models, limit = 2)
+    second, last = await model.children_page("elements", models, limit = 2, after = token)
+
+    self.assertEqual([child["slug"] for child in first.get_data()], ["child-1", "child-2"])
+    self.assertEqual([child["slug"] for child in second.get_data()], ["child-3"])
+    self.assertIsNone(last)
+
+  async def testStream(self):
+    model = models.RealMongoTree(self.table)
+    await model.get(_id = self.papers[-1]["_id"])
+    batches = [batch async for batch in model.stream_children("elements", models, batch_size = 2)]
+    slugs = [child["slug"] for batch in batches for child in batch.get_data()]
+
+    self.assertEqual(len(batches), 2)
+    self.assertEqual(slugs, ["child-1", "child-2", "child-3"])
+
 class TestDeleteTree(AioTestCase):
   async def setUp(self):
     self.client = AsyncIOMotorClient(MONGO_URI)
@@ -401,3 +716,559 @@ class TestUpdateField(AioTestCase):
 
     with self.assertRaises(ValidationError):
       await model.update({"path": 25}, models)
+
+  async def testSlug(self):
+    model = models.RealMongoTree(self.table)
+    await model.get(_id = self.papers[-1]["_id"])
+    updated = await model.update({"slug": "renamed"}, models)
+
+    children = await self.table.find({"path": "/testupdatefield/renamed"}).to_list(None)
+
+    self.assertEqual(len(children), 5)
+    self.assertEqual(updated.rewritten, 5)
+    self.assertFalse(await self.table.find({"path": "/testupdatefield/paper"}).to_list(None))
+
+  async def testRewritePaths(self):
+    model = models.RealMongoTree(self.table)
+    await model.get(_id = self.papers[-1]["_id"])
+    modified = await model.rewrite_paths("/testupdatefield/paper", "/testupdatefield/rewritten", batch_size = 2)
+
+    self.assertEqual(modified, 5)
+
+class TestSubtreeQuery(AioTestCase):
+  async def setUp(self):
+    self.client = AsyncIOMotorClient(MONGO_URI)
+    self.table = self.client.tests.indexes
+
+    self.papers = [
+      {"type": "RealMongoTree", "path": "/a", "name": "Foo", "slug": "foo"},
+      {"type": "RealMongoTree", "path": "/a", "name": "Foobar", "slug": "foobar"},
+      {"type": "RealMongoTree", "path": "/a/foo", "name": "Child", "slug": "child"},
+      {"type": "RealMongoTree", "path": "/a/foo/child", "name": "Grandchild", "slug": "grandchild"},
+      {"type": "RealMongoTree", "path": "/a/foobar", "name": "Sibling child", "slug": "sibling-child"}
+    ]
+
+    for paper in self.papers:
+      result = await self.table.insert_one(paper)
+      paper["_id"] = result.inserted_id
+
+  async def tearDown(self):
+    await self.table.drop()
+    self.client.close()
+
+  def testQuery(self):
+    self.assertEqual(subtree_query("/"), {"path": {"$regex": "^/"}})
+    self.assertEqual(subtree_query("/a/foo.bar"), {"$or": [{"path": "/a/foo.bar"}, {"path": {"$regex": "^/a/foo\\.bar/"}}]})
+
+  async def testSiblings(self):
+    docs = await self.table.find(subtree_query("/a/foo")).to_list(None)
+
+    self.assertEqual(sorted(doc["slug"] for doc in docs), ["child", "grandchild"])
+
+  async def testDepth(self):
+    children = await self.table.find(subtree_query("/a/foo", 1)).to_list(None)
+    two = await self.table.find(subtree_query("/a", 2)).to_list(None)
+
+    self.assertEqual([doc["slug"] for doc in children], ["child"])
+    self.assertEqual(sorted(doc["slug"] for doc in two), ["child", "foo", "foobar", "sibling-child"])
+
+  async def testDescendants(self):
+    node = models.RealMongoTree(self.table)
+    node.load({"path": "/", "name": "A", "slug": "a"})
+
+    def slugs(entries):
+      return [(entry["node"].slug, slugs(entry["children"])) for entry in entries]
+
+    self.assertEqual([child.slug for child in await node.descendants(models)], ["foo", "foobar", "child", "grandchild", "sibling-child"])
+    self.assertEqual([child.slug for child in await node.descendants(models, max_depth = 2)], ["foo", "foobar", "child", "sibling-child"])
+    self.assertEqual(await node.descendants(models, types = ["User"]), [])
+    self.assertEqual(slugs(await node.descendants(models, nested = True)), [
+      ("foo", [("child", [("grandchild", [])])]),
+      ("foobar", [("sibling-child", [])])
+    ])
+
+  async def testExplain(self):
+    await models.RealMongoTree(self.table).ensure_indexes()
+    explain = await self.table.find(subtree_query("/a/foo")).explain()
+    plan = dumps(explain["queryPlanner"]["winningPlan"])
+
+    self.assertIn("IXSCAN", plan)
+    self.assertNotIn("COLLSCAN", plan)
+
+class TestChangeStreamInvalidator(AioTestCase):
+  # needs a replica set (a single node one is enough) as the transactions do
+  async def setUp(self):
+    self.client = AsyncIOMotorClient(MONGO_URI)
+    self.table = self.client.tests.tests
+    self.cache = NodeCache()
+    self.store = MongoTokenStore(self.client.tests.tokens, "tests")
+    self.doc = {"type": "MinimalMongoTree", "path": "/", "name": "Watched", "slug": "watched"}
+    result = await self.table.insert_one(self.doc)
+    self.doc["_id"] = result.inserted_id
+
+    self.invalidator = ChangeStreamInvalidator(self.table, self.cache, self.store)
+    self.invalidator.start()
+
+  async def tearDown(self):
+    await self.invalidator.stop()
+    await self.table.delete_one({"_id": self.doc["_id"]})
+    await self.client.tests.tokens.drop()
+    self.client.close()
+
+  async def test(self):
+    for i in range(50):
+      if self.invalidator.active:
+        break
+      await sleep(0.1)
+
+    self.cache.put(self.doc)
+    await self.table.update_one({"_id": self.doc["_id"]}, {"$set": {"name": "Changed elsewhere"}})
+    for i in range(50):
+      if self.cache.peek(self.doc["_id"]) is None:
+        break
+      await sleep(0.1)
+
+    self.assertIsNone(self.cache.peek(self.doc["_id"]))
+    self.assertIsNotNone(await self.store.load())
+
+class TestCreateChild(AioTestCase):
+  async def setUp(self):
+    self.client = AsyncIOMotorClient(MONGO_URI)
+    self.table = self.client.tests.tests
+    self.parent = {"type": "RealMongoTree", "path": "/", "name": "Test create child", "slug": "test-create-child", "members": [], "elements": []}
+    result = await self.table.insert_one(self.parent)
+    self.parent["_id"] = result.inserted_id
+
+  async def tearDown(self):
+    await self.table.delete_many(subtree_query("/test-create-child"))
+    await self.table.delete_one({"_id": self.parent["_id"]})
+    self.client.close()
+
+  async def test(self):
+    parent = models.RealMongoTree(self.table)
+    await parent.get(_id = self.parent["_id"])
+    first = models.RealMongoTree()
+    first.load({"path": "/test-create-child", "name": "First"})
+    second = models.RealMongoTree()
+    second.load({"path": "/test-create-child", "name": "Second"})
+    await parent.create_child(second, "elements")
+    await parent.create_child(first, "elements", position = 0)
+
+    saved = await self.table.find_one({"_id": self.parent["_id"]})
+
+    self.assertEqual(saved["elements"], ["first", "second"])
+    self.assertEqual(parent.elements, ["first", "second"])
+
+  async def testMany(self):
+    await models.RealMongoTree(self.table).ensure_indexes()
+    parent = models.RealMongoTree(self.table)
+    await parent.get(_id = self.parent["_id"])
+    children, errors = await parent.create_children([{"name": "One"}, {"name": "Two"}, {"name": "One"}], "elements", models)
+    saved = await self.table.find_one({"_id": self.parent["_id"]})
+
+    self.assertEqual([child["slug"] for child in children.get_data()], ["one", "two"])
+    self.assertIsInstance(errors[2], URIAlreadyExists)
+    self.assertEqual(saved["elements"], ["one", "two"])
+
+  async def testManyDeeper(self):
+    parent = models.RealMongoTree(self.table)
+    await parent.get(_id = self.parent["_id"])
+    rows = [{"name": "Deeper", "path": "/test-create-child/folder"}, {"name": "Folder"}, {"name": "Deepest", "path": "/test-create-child/folder/deeper"}, {"name": "Elsewhere", "path": "/elsewhere"}]
+    children, errors = await parent.create_children(rows, "elements", models)
+    folder = await self.table.find_one({"path": "/test-create-child", "slug": "folder"})
+    deeper = await self.table.find_one({"path": "/test-create-child/folder", "slug": "deeper"})
+
+    self.assertEqual([child["slug"] for child in children.get_data()], ["folder", "deeper", "deepest"])
+    self.assertEqual(list(errors), [3])
+    self.assertIn("path", errors[3])
+    self.assertEqual(folder["elements"], ["deeper"])
+    self.assertEqual(deeper["elements"], ["deepest"])
+    self.assertEqual(parent.elements, ["folder"])
+    self.assertEqual(rows[1], {"name": "Folder"})
+    self.assertIsNone(await self.table.find_one({"path": "/elsewhere"}))
+
+  async def testConcurrent(self):
+    async def create(i):
+      # every worker has its own (soon stale) copy of the parent
+      parent = models.RealMongoTree(self.table)
+      await parent.get(_id = self.parent["_id"])
+      child = models.RealMongoTree()
+      child.load({"path": "/test-create-child", "name": "Child {}".format(i)})
+      await parent.create_child(child, "elements")
+
+    await gather(*[create(i) for i in range(50)])
+    saved = await self.table.find_one({"_id": self.parent["_id"]})
+
+    self.assertEqual(sorted(saved["elements"]), sorted("child-{}".format(i) for i in range(50)))
+
+  async def testDelete(self):
+    parent = models.RealMongoTree(self.table)
+    await parent.get(_id = self.parent["_id"])
+    child = models.RealMongoTree()
+    child.load({"path": "/test-create-child", "name": "To delete"})
+    await parent.create_child(child, "elements")
+    await child.delete(models)
+
+    saved = await self.table.find_one({"_id": self.parent["_id"]})
+
+    self.assertEqual(saved["elements"], [])
+
+async def stored_aggregates(table, _id):
+  node = models.AggregatedTree(table)
+  await node.get(_id = _id)
+  return node.get_aggregates()
+
+class TestAggregates(AioTestCase):
+  async def setUp(self):
+    self.client = AsyncIOMotorClient(MONGO_URI)
+    self.table = self.client.tests.tests
+    self.root = {"type": "AggregatedTree", "path": "/", "name": "Test aggregates", "slug": "test-aggregates", "members": [], "elements": []}
+    result = await self.table.insert_one(self.root)
+    self.root["_id"] = result.inserted_id
+
+    self.parent = models.AggregatedTree(self.table)
+    await self.parent.get(_id = self.root["_id"])
+    self.folder = models.AggregatedTree()
+    self.folder.load({"path": "/test-aggregates", "name": "Folder", "size": 5})
+    await self.parent.create_child(self.folder, "elements")
+    self.children, errors = await self.folder.create_children([{"name": "One", "size": 1}, {"name": "Two", "size": 2}], "elements", models)
+    user = models.User()
+    user.load({"path": "/test-aggregates", "name": "User"})
+    await self.parent.create_child(user, "members")
+
+  async def tearDown(self):
+    await self.table.delete_many(subtree_query("/test-aggregates"))
+    await self.table.delete_one({"_id": self.root["_id"]})
+    self.client.close()
+
+  async def test(self):
+    self.assertEqual(await stored_aggregates(self.table, self.root["_id"]), {"children": {"elements": 1, "members": 1}, "descendants": 4, "sums": {"size": 8}})
+    self.assertEqual(await stored_aggregates(self.table, self.folder._id), {"children": {"elements": 2}, "descendants": 2, "sums": {"size": 3}})
+    self.assertEqual(self.parent.get_aggregates()["children"], {"elements": 1, "members": 1})
+
+  async def testSubtree(self):
+    await self.parent.create_children([{"name": "Box", "size": 1}, {"name": "Inner", "size": 2, "path": "/test-aggregates/box"}, {"name": "Item", "size": 3, "path": "/test-aggregates/box/inner"}], "elements", models)
+
+    self.assertEqual(await stored_aggregates(self.table, self.root["_id"]), {"children": {"elements": 2, "members": 1}, "descendants": 7, "sums": {"size": 14}})
+    self.assertEqual(self.parent.get_aggregates()["children"], {"elements": 2, "members": 1})
+    box = await self.table.find_one({"path": "/test-aggregates", "slug": "box"})
+    self.assertEqual(box["_aggregates"], {"children": {"elements": 1}, "descendants": 2, "sums": {"size": 5}})
+
+  async def testForged(self):
+    forged = {"children": {"elements": 50}, "descendants": 1000, "sums": {"size": 1000}}
+    child = models.AggregatedTree()
+    child.load({"path": "/test-aggregates", "name": "Forged", "size": 1, "_aggregates": forged})
+    await self.parent.create_child(child, "elements")
+    await self.parent.create_children([{"name": "Forged many", "size": 1, "_aggregates": forged}], "elements", models)
+
+    self.assertEqual(await stored_aggregates(self.table, self.root["_id"]), {"children": {"elements": 3, "members": 1}, "descendants": 6, "sums": {"size": 10}})
+    self.assertNotIn("_aggregates", await self.table.find_one({"_id": child._id}))
+    self.assertNotIn("_aggregates", await self.table.find_one({"path": "/test-aggregates", "slug": "forged-many"}))
+
+  async def testBulkUpdate(self):
+    ids = [doc["_id"] for doc in self.children.get_data()]
+    with self.assertRaises(ValidationError) as context:
+      await models.AggregatedTree.bulk_update(self.table, [{"_id": ids[0], "size": 10}, {"_id": ids[1], "slug": "moved"}, {"_id": ids[1], "name": "Fine"}])
+
+    self.assertEqual(sorted(context.exception.messages), [0, 1])
+    self.assertIn("size", context.exception.messages[0])
+    self.assertIn("slug", context.exception.messages[1])
+    self.assertEqual((await self.table.find_one({"_id": ids[1]}))["name"], "Two")
+
+    models.AggregatedTree.cache = NodeCache()
+    try:
+      models.AggregatedTree.cache.put(await self.table.find_one({"_id": ids[0]}))
+      await models.AggregatedTree.bulk_update(self.table, [{"_id": ids[0], "name": "Renamed"}])
+
+      self.assertIsNone(models.AggregatedTree.cache.peek(ids[0]))
+    finally:
+      del models.AggregatedTree.cache
+
+  async def testUpdate(self):
+    child = models.AggregatedTree(self.table)
+    await child.get(_id = self.children.get_data()[0]["_id"])
+    await child.update({"size": 10}, models)
+
+    self.assertEqual((await stored_aggregates(self.table, self.root["_id"]))["sums"], {"size": 17})
+    self.assertEqual((await stored_aggregates(self.table, self.folder._id))["sums"], {"size": 12})
+
+  async def testUpdateLoaded(self):
+    child = models.AggregatedTree(self.table)
+    await child.get(_id = self.children.get_data()[0]["_id"])
+    await child.update({"size": "5"}, models)
+
+    self.assertEqual((await stored_aggregates(self.table, self.root["_id"]))["sums"], {"size": 12})
+    self.assertEqual((await self.table.find_one({"_id": child._id}))["size"], 5)
+
+    with self.assertRaises(ValidationError):
+      await child.update({"size": "five", "name": "Five"}, models)
+
+    self.assertEqual((await stored_aggregates(self.table, self.root["_id"]))["sums"], {"size": 12})
+    self.assertEqual((await self.table.find_one({"_id": child._id}))["name"], "One")
+
+  async def testDelete(self):
+    await self.table.update_one({"_id": self.folder._id}, {"$set": {"type": "AggregatedTree"}})
+    folder = models.AggregatedTree(self.table)
+    await folder.get(_id = self.folder._id)
+    await folder.delete(models)
+
+    self.assertEqual(await stored_aggregates(self.table, self.root["_id"]), {"children": {"elements": 0, "members": 1}, "descendants": 1, "sums": {"size": 0}})
+
+  async def testMove(self):
+    await self.table.update_one({"_id": self.folder._id}, {"$set": {"type": "AggregatedTree"}})
+    child = models.AggregatedTree(self.table)
+    await child.get(_id = self.children.get_data()[0]["_id"])
+    await child.move(self.parent, "elements", models)
+
+    self.assertEqual(await stored_aggregates(self.table, self.root["_id"]), {"children": {"elements": 2, "members": 1}, "descendants": 4, "sums": {"size": 8}})
+    self.assertEqual(await stored_aggregates(self.table, self.folder._id), {"children": {"elements": 1}, "descendants": 1, "sums": {"size": 2}})
+
+  async def testRepair(self):
+    expected = [await stored_aggregates(self.table, self.root["_id"]), await stored_aggregates(self.table, self.folder._id)]
+    await self.table.update_many({"$or": [{"_id": self.root["_id"]}, subtree_query("/test-aggregates")]}, {"$unset": {"_aggregates": 1}})
+
+    await self.parent.repair_aggregates(models)
+
+    self.assertEqual([await stored_aggregates(self.table, self.root["_id"]), await stored_aggregates(self.table, self.folder._id)], expected)
+
+async def tree_node(table, path, slug, model = None):
+  node = (model or models.RealMongoTree)(table)
+  await node.get(path = path, slug = slug)
+  return node
+
+class TestMove(AioTestCase):
+  async def setUp(self):
+    self.client = AsyncIOMotorClient(MONGO_URI)
+    self.table = self.client.tests.tests
+    await models.RealMongoTree(self.table).ensure_indexes()
+    self.docs = [
+      {"type": "RealMongoTree", "path": "/", "name": "Test move", "slug": "test-move", "members": [], "elements": ["a", "b"]},
+      {"type": "RealMongoTree", "path": "/test-move", "name": "A", "slug": "a", "members": [], "elements": ["child"]},
+      {"type": "RealMongoTree", "path": "/test-move/a", "name": "Child", "slug": "child", "members": [], "elements": []},
+      {"type": "RealMongoTree", "path": "/test-move", "name": "B", "slug": "b", "members": [], "elements": []}
+    ]
+    await self.table.insert_many(self.docs)
+
+  async def tearDown(self):
+    await self.table.delete_many(subtree_query("/test-move"))
+    await self.table.delete_one({"_id": self.docs[0]["_id"]})
+    self.client.close()
+
+  async def test(self):
+    node = await tree_node(self.table, "/test-move", "a")
+    target = await tree_node(self.table, "/test-move", "b")
+    await node.move(target, "elements", models)
+
+    paths = {doc["slug"]: doc["path"] async for doc in self.table.find(subtree_query("/test-move"))}
+    root = await self.table.find_one({"_id": self.docs[0]["_id"]})
+    saved = await self.table.find_one({"_id": self.docs[3]["_id"]})
+
+    self.assertEqual(paths, {"a": "/test-move/b", "child": "/test-move/b/a", "b": "/test-move"})
+    self.assertEqual(root["elements"], ["b"])
+    self.assertEqual(saved["elements"], ["a"])
+    self.assertEqual(node.get_url(), "/test-move/b/a")
+
+  async def testCycle(self):
+    node = await tree_node(self.table, "/test-move", "a")
+    target = await tree_node(self.table, "/test-move/a", "child")
+
+    with self.assertRaises(InvalidOperation):
+      await node.move(target, "elements", models)
+
+    with self.assertRaises(InvalidOperation):
+      await node.move(node, "elements", models)
+
+  async def testExisting(self):
+    await self.table.insert_one({"type": "RealMongoTree", "path": "/test-move/b", "name": "A", "slug": "a"})
+    node = await tree_node(self.table, "/test-move", "a")
+    target = await tree_node(self.table, "/test-move", "b")
+
+    with self.assertRaises(URIAlreadyExists):
+      await node.move(target, "elements", models)
+
+class TestWriteConcern(TestCase):
+  def test(self):
+    tree = models.BulkTree()
+    self.assertIsNone(tree.write_concern_of())
+    self.assertEqual(tree.write_concern_of({"w": "majority", "j": True}), WriteConcern(w = "majority", j = True))
+    self.assertEqual(tree.write_concern_of(WriteConcern(w = 1)), WriteConcern(w = 1))
+
+  def testRestoring(self):
+    self.assertEqual(restoring({"path": "/a"}, {"path": "/b", "_rank": "i"}), {"$set": {"path": "/a"}, "$unset": {"_rank": 1}})
+    self.assertEqual(restoring({"path": "/a", "_rank": "h"}, {"path": "/b", "_rank": "i"}), {"$set": {"path": "/a", "_rank": "h"}})
+
+class TestWritePolicy(AioTestCase):
+  async def setUp(self):
+    self.client = AsyncIOMotorClient(MONGO_URI)
+    self.table = self.client.tests.tests
+    await models.BulkTree(self.table).ensure_indexes()
+    self.docs = [
+      {"type": "BulkTree", "path": "/", "name": "Test policy", "slug": "test-policy", "members": [], "elements": ["a"]},
+      {"type": "BulkTree", "path": "/test-policy", "name": "A", "slug": "a", "members": [], "elements": []}
+    ]
+    await self.table.insert_many(self.docs)
+
+  async def tearDown(self):
+    await self.table.delete_many(subtree_query("/test-policy"))
+    await self.table.delete_one({"_id": self.docs[0]["_id"]})
+    self.client.close()
+
+  async def test(self):
+    parent = await tree_node(self.table, "/", "test-policy", models.BulkTree)
+    child = models.BulkTree()
+    child.load({"type": "BulkTree", "name": "B", "slug": "b", "path": "/test-policy"})
+    await parent.create_child(child, "elements", write_concern = {"w": 1, "j": True})
+
+    node = await tree_node(self.table, "/test-policy", "a", models.BulkTree)
+    await node.update({"slug": "c"}, models, write_policy = "single")
+    await child.delete(models)
+
+    root = await self.table.find_one({"_id": self.docs[0]["_id"]})
+    self.assertEqual(root["elements"], ["c"])
+    self.assertEqual([doc["slug"] async for doc in self.table.find(subtree_query("/test-policy"))], ["c"])
+
+  async def testRenameExisting(self):
+    await self.table.insert_many([
+      {"type": "BulkTree", "path": "/test-policy", "name": "B", "slug": "b", "members": [], "elements": ["y"]},
+      {"type": "BulkTree", "path": "/test-policy/a", "name": "X", "slug": "x", "members": [], "elements": []},
+      {"type": "BulkTree", "path": "/test-policy/b", "name": "Y", "slug": "y", "members": [], "elements": []}
+    ])
+    await self.table.update_one({"_id": self.docs[0]["_id"]}, {"$set": {"elements": ["a", "b"]}})
+    node = await tree_node(self.table, "/test-policy", "a", models.BulkTree)
+
+    with self.assertRaises(URIAlreadyExists):
+      await node.update({"slug": "b"}, models)
+
+    root = await self.table.find_one({"_id": self.docs[0]["_id"]})
+    paths = {doc["slug"]: doc["path"] async for doc in self.table.find(subtree_query("/test-policy"))}
+    self.assertEqual(root["elements"], ["a", "b"])
+    self.assertEqual(paths, {"a": "/test-policy", "b": "/test-policy", "x": "/test-policy/a", "y": "/test-policy/b"})
+    self.assertEqual(node.slug, "a")
+
+  async def testUnknown(self):
+    node = await tree_node(self.table, "/test-policy", "a", models.BulkTree)
+    with self.assertRaises(InvalidOperation):
+      await node.delete(models, write_policy = "eventually")
+
+  async def testCompensation(self):
+    async def failing(*args, **kwargs):
+      raise PyMongoError("failed")
+
+    parent = await tree_node(self.table, "/", "test-policy", models.BulkTree)
+    parent.propagate_aggregates = failing
+    parent.aggregates = True
+    child = models.BulkTree()
+    child.load({"type": "BulkTree", "name": "B", "slug": "b", "path": "/test-policy"})
+    with self.assertRaises(PyMongoError):
+      await parent.create_child(child, "elements")
+
+    root = await self.table.find_one({"_id": self.docs[0]["_id"]})
+    self.assertEqual(root["elements"], ["a"])
+    self.assertIsNone(await self.table.find_one({"path": "/test-policy", "slug": "b"}))
+
+    node = await tree_node(self.table, "/test-policy", "a", models.BulkTree)
+    node.rewrite_paths = failing
+    with self.assertRaises(PyMongoError):
+      await node.update({"slug": "c"}, models)
+
+    root = await self.table.find_one({"_id": self.docs[0]["_id"]})
+    self.assertEqual(root["elements"], ["a"])
+
+  async def testSingle(self):
+    async def failing(*args, **kwargs):
+      raise PyMongoError("failed")
+
+    parent = await tree_node(self.table, "/", "test-policy", models.BulkTree)
+    parent.propagate_aggregates = failing
+    parent.aggregates = True
+    child = models.BulkTree()
+    child.load({"type": "BulkTree", "name": "B", "slug": "b", "path": "/test-policy"})
+    with self.assertRaises(PyMongoError):
+      await parent.create_child(child, "elements", write_policy = "single")
+
+    root = await self.table.find_one({"_id": self.docs[0]["_id"]})
+    self.assertEqual(root["elements"], ["a", "b"])
+
+class TestRanks(TestCase):
+  def test(self):
+    self.assertEqual(rank_between(), "i")
+    self.assertEqual(rank_between("az", "b"), "azi")
+    self.assertLess("a", rank_between("a", "a1"))
+    self.assertRaises(ValidationError, rank_between, "b", "a")
+    for before, after in (("ZZ", None), (None, "0"), ("i", "i0"), ("", "i")):
+      self.assertRaises(ValidationError, rank_between, before, after)
+
+  def testMany(self):
+    ranks = ranks_between("a", "b", 100)
+
+    self.assertEqual(ranks, sorted(set(ranks)))
+    self.assertTrue(all("a" < rank < "b" and not rank.endswith("0") for rank in ranks))
+
+class TestRankOrder(AioTestCase):
+  async def setUp(self):
+    self.client = AsyncIOMotorClient(MONGO_URI)
+    self.table = self.client.tests.tests
+    self.root = {"type": "RankedTree", "path": "/", "name": "Test rank order", "slug": "test-rank-order", "elements": []}
+    result = await self.table.insert_one(self.root)
+    self.root["_id"] = result.inserted_id
+    self.parent = models.RankedTree(self.table)
+    await self.parent.get(_id = self.root["_id"])
+
+  async def tearDown(self):
+    await self.table.delete_many(subtree_query("/test-rank-order"))
+    await self.table.delete_one({"_id": self.root["_id"]})
+    self.client.close()
+
+  async def test(self):
+    await self.parent.create_children([{"name": name, "type": "RankedTree"} for name in ["A", "B", "C"]], "elements", models)
+    first = models.RankedTree()
+    first.load({"path": "/test-rank-order", "name": "First", "type": "RankedTree"})
+    await self.parent.create_child(first, "elements", position = 0)
+
+    children = await self.parent.children("elements", models)
+    self.assertEqual([child["slug"] for child in children.get_data()], ["first", "a", "b", "c"])
+
+    last = models.RankedTree(self.table)
+    await last.get(path = "/test-rank-order", slug = "c")
+    await self.parent.reorder(last, "elements", 1)
+
+    children = await self.parent.children("elements", models)
+    page, token = await self.parent.children_page("elements", models, limit = 3)
+    rest, end = await self.parent.children_page("elements", models, limit = 3, after = token)
+
+    self.assertEqual([child["slug"] for child in children.get_data()], ["first", "c", "a", "b"])
+    self.assertEqual([child["slug"] for child in page.get_data() + rest.get_data()], ["first", "c", "a", "b"])
+    self.assertIsNone(end)
+
+  async def testForged(self):
+    child = models.RankedTree()
+    child.load({"path": "/test-rank-order", "name": "Forged", "type": "RankedTree", "_rank": "ZZ"})
+    await self.parent.create_child(child, "elements")
+    await self.parent.create_children([{"name": "Forged many", "type": "RankedTree", "_rank": "0"}], "elements", models)
+    await child.update({"_rank": "i0"})
+    last = models.RankedTree()
+    last.load({"path": "/test-rank-order", "name": "Last", "type": "RankedTree"})
+    await self.parent.create_child(last, "elements")
+
+    children = await self.parent.children("elements", models)
+    self.assertEqual([child["slug"] for child in children.get_data()], ["forged", "forged-many", "last"])
+    self.assertNotIn((await self.table.find_one({"_id": child._id}))["_rank"], ("ZZ", "i0"))
+
+  async def testSubtree(self):
+    rows = [{"name": name, "type": "RankedTree", "path": "/test-rank-order/a"} for name in ["Z", "Y"]]
+    await self.parent.create_children([{"name": "A", "type": "RankedTree"}] + rows, "elements", models)
+    folder = models.RankedTree(self.table)
+    await folder.get(path = "/test-rank-order", slug = "a")
+    children = await folder.children("elements", models)
+
+    self.assertEqual([child["slug"] for child in children.get_data()], ["z", "y"])
+    self.assertNotIn("_rank", rows[0])
+
+  async def testMigrate(self):
+    await self.table.insert_many([{"type": "RankedTree", "path": "/test-rank-order", "name": name, "slug": name} for name in ["x", "y", "z"]])
+    await self.table.update_one({"_id": self.root["_id"]}, {"$set": {"elements": ["z", "x"]}})
+
+    await self.parent.migrate_order(models)
+    children = await self.parent.children("elements", models)
+
+    self.assertEqual([child["slug"] for child in children.get_data()], ["z", "x", "y"])
@@ -1,9 +1,12 @@
-from json import dumps
+from json import dumps, loads
 
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 
 from tests import models
 
+from yModel import json_backends, prototypes, set_slug_cache_size, slug_cache_info
+from yModel.batch import Columns
+from yModel.cache import NodeCache, ChangeStreamInvalidator
 from yModel.utils import AioTestCase
 
 class FakeApp():
@@ -45,6 +48,32 @@ class TestMinimal(TestCase):
 
     self.assertEqual(json, dumps(data))
 
+  def testPlainDict(self):
+    model = models.Minimal()
+    data = {"name": "Plain dict"}
+    model.load(data)
+
+    self.assertDictEqual(model.to_plain_dict(), data)
+    self.assertDictEqual(model.to_plain_dict(["name"]), {})
+    self.assertDictEqual(model.get_data(), data)
+
+  @skipUnless("orjson" in json_backends, "orjson is not installed")
+  def testJsonBackend(self):
+    model = models.Minimal()
+    model.json_backend = "orjson"
+    data = {"name": "JSON backend"}
+    model.load(data)
+
+    self.assertDictEqual(loads(model.to_json()), data)
+
+  def testReload(self):
+    model = models.Minimal()
+    model.load({"title": "Errors"})
+    model.load({"name": "Reloaded"})
+
+    self.assertDictEqual(model.get_data(), {"name": "Reloaded"})
+    self.assertIsNone(model.get_errors())
+
   def testAttributeAccess(self):
     model = models.Minimal()
     data = {"name": "Attribute access"}
@@ -52,6 +81,304 @@ class TestMinimal(TestCase):
 
     self.assertEqual(model.name, data["name"])
 
+class TestSpawn(TestCase):
+  def test(self):
+    valid = models.Minimal.spawn()
+    invalid = models.Minimal.spawn()
+    valid.load({"name": "Spawned"})
+    invalid.load({"title": "Spawned"})
+
+    self.assertIsInstance(valid, models.Minimal)
+    self.assertDictEqual(valid.get_data(), {"name": "Spawned"})
+    self.assertIsNone(valid.get_errors())
+    self.assertDictEqual(invalid.get_data(), {})
+    self.assertIn("name", invalid.get_errors())
+
+  def testMany(self):
+    model = models.Minimal.spawn(many = True)
+    model.load([{"name": "First"}, {"name": "Second"}], many = True)
+
+    self.assertEqual(len(model.get_data()), 2)
+    self.assertEqual(models.Minimal.spawn(many = True).get_data(), [])
+
+  def testOnly(self):
+    size = len(prototypes)
+    models.RealTree.spawn(only = ("slug", "name"))
+    models.RealTree.spawn(only = ("name", "slug"))
+    models.RealTree.spawn(only = ("name", "unknown"))
+    model = models.RealTree.spawn(only = ("name", "another"))
+    model.load({"name": "Only", "another": 1})
+
+    self.assertEqual(len(prototypes), size + 1)
+    self.assertEqual(model.get_data(), {"name": "Only", "another": 1})
+
+  def testOwnState(self):
+    first = models.Stateful.spawn()
+    second = models.Stateful.spawn()
+    first.seen.append("first")
+
+    self.assertEqual(second.seen, [])
+
+  def testMethodFields(self):
+    model = models.Greeting.spawn()
+    model.context["greeting"] = "Hi"
+
+    self.assertIs(model.fields["greeting"].parent, model)
+    self.assertEqual(model.dump({"name": "there"}).data["greeting"], "Hi there")
+    self.assertEqual(models.Greeting.spawn().dump({"name": "there"}).data["greeting"], "Hello there")
+
+class TestNodeCache(TestCase):
+  def setUp(self):
+    self.cache = NodeCache(maxsize = 3)
+    self.docs = [
+      {"_id": 1, "path": "", "slug": "root"},
+      {"_id": 2, "path": "/", "slug": "parent"},
+      {"_id": 3, "path": "/parent", "slug": "child"},
+      {"_id": 4, "path": "/parent/child", "slug": "grandchild"}
+    ]
+    for doc in self.docs[:3]:
+      self.cache.put(doc)
+
+  def test(self):
+    self.assertEqual(self.cache.get_path(""), self.docs[0])
+    self.assertEqual(self.cache.get_path("/parent", "child"), self.docs[2])
+    self.assertEqual(self.cache.get(2), self.docs[1])
+    self.assertIsNone(self.cache.get_path("/", "nope"))
+    self.assertEqual(self.cache.stats()["hits"], 3)
+    self.assertEqual(self.cache.stats()["misses"], 1)
+
+  def testLRU(self):
+    self.cache.get(1)
+    self.cache.put(self.docs[3])
+
+    self.assertIsNone(self.cache.get_path("/", "parent"))
+    self.assertEqual(self.cache.get(1), self.docs[0])
+    self.assertEqual(self.cache.stats()["size"], 3)
+
+  def testTTL(self):
+    cache = NodeCache(ttl = -1)
+    cache.put(self.docs[0])
+
+    self.assertIsNone(cache.get(1))
+    self.assertEqual(cache.stats()["size"], 0)
+
+  def testInvalidate(self):
+    self.cache.invalidate(path = "/parent", slug = "child")
+    self.cache.invalidate(1)
+
+    self.assertIsNone(self.cache.get(3))
+    self.assertIsNone(self.cache.get_path(""))
+    self.assertEqual(self.cache.get(2), self.docs[1])
+
+  def testSubtree(self):
+    self.cache.invalidate_subtree("/parent")
+
+    self.assertIsNone(self.cache.get(3))
+    self.assertEqual(self.cache.get(2), self.docs[1])
+
+    self.cache.invalidate_subtree("/")
+
+    self.assertIsNone(self.cache.get(2))
+    self.assertEqual(self.cache.get(1), self.docs[0])
+
+class TestChangeStreamInvalidator(TestCase):
+  def setUp(self):
+    self.cache = NodeCache()
+    self.docs = [
+      {"_id": 1, "path": "/", "slug": "parent"},
+      {"_id": 2, "path": "/parent", "slug": "child"},
+      {"_id": 3, "path": "/other", "slug": "child"}
+    ]
+    for doc in self.docs:
+      self.cache.put(doc)
+
+    self.invalidator = ChangeStreamInvalidator(None, self.cache)
+
+  def testUpdate(self):
+    self.invalidator.apply({"operationType": "update", "documentKey": {"_id": 3}, "updateDescription": {"updatedFields": {"name": "Changed"}}})
+
+    self.assertIsNone(self.cache.peek(3))
+    self.assertEqual(self.cache.stats()["size"], 2)
+
+  def testRename(self):
+    self.invalidator.apply({"operationType": "update", "documentKey": {"_id": 1}, "updateDescription": {"updatedFields": {"slug": "renamed"}}})
+
+    self.assertIsNone(self.cache.peek(1))
+    self.assertIsNone(self.cache.peek(2))
+    self.assertEqual(self.cache.peek(3), self.docs[2])
+
+  def testDelete(self):
+    self.invalidator.apply({"operationType": "delete", "documentKey": {"_id": 2}})
+
+    self.assertIsNone(self.cache.get_path("/parent", "child"))
+
+  def testDrop(self):
+    self.invalidator.apply({"operationType": "drop"})
+
+    self.assertEqual(self.cache.stats()["size"], 0)
+
+class TestBatchLoad(TestCase):
+  def setUp(self):
+    self.data = [
+      {"path": "/", "name": "Batch"},
+      {"path": "/", "name": "Batch elements", "elements": ["a", "b"]},
+      {"path": 25, "name": "Bad path", "slug": "bad-path"},
+      {"name": "No path", "elements": "not a list"},
+      {"path": "/", "name": "Unknown field", "unknown": True}
+    ]
+
+  def load(self, batch_load, partial = None):
+    model = models.RealTree(many = True)
+    model.batch_load = batch_load
+    model.load([dict(row) for row in self.data], many = True, partial = partial)
+    return [dict(row) for row in model.get_data()], model.get_errors()
+
+  def test(self):
+    self.assertEqual(self.load(True), self.load(False))
+    self.assertEqual(self.load(True)[0][0], {"name": "Batch", "path": "/", "slug": "batch"})
+    self.assertEqual(sorted(self.load(True)[1].keys()), [2, 3])
+
+  def testPartial(self):
+    self.assertEqual(self.load(True, True), self.load(False, True))
+    self.assertEqual(self.load(True, ("path", )), self.load(False, ("path", )))
+
+class TestHydrate(TestCase):
+  def test(self):
+    model = models.RealTree()
+    data = {"path": "/", "name": "Hydrated", "slug": "stored", "type": "RealTree"}
+    model.hydrate(data)
+
+    self.assertEqual(model.get_data(), {"path": "/", "name": "Hydrated", "slug": "stored"})
+    self.assertIsNone(model.get_errors())
+
+  def testSame(self):
+    data = {"path": "/", "name": "Hydrated", "slug": "stored"}
+    model = models.RealTree()
+    model.hydrate(data)
+
+    self.assertIs(model.get_data(), data)
+
+  def testCheck(self):
+    model = models.RealTree(many = True)
+    model.hydrate([{"path": "/", "name": "Hydrated", "slug": "stored"}, {"path": "/", "name": "No slug"}], many = True, check = True)
+
+    self.assertEqual(len(model.get_data()), 2)
+    self.assertEqual(model.get_errors(), {1: {"slug": ["Missing data for required field."]}})
+
+    model.hydrate([{"path": "/", "name": "No slug"}], many = True)
+    self.assertIsNone(model.get_errors())
+
+  def testDefaults(self):
+    model = models.NameOnlyOkSchema()
+    model.hydrate({"name": "Hydrated"})
+
+    self.assertEqual(model.get_data(), {"name": "Hydrated", "ok": True})
+
+class TestLazyLoad(TestCase):
+  def setUp(self):
+    self.data = {"path": "/", "name": "Lazy", "elements": ["a", 2, "c"]}
+
+  def test(self):
+    model = models.RealTree()
+    model.load(dict(self.data), lazy = True)
+
+    self.assertEqual(model.name, "Lazy")
+    self.assertEqual(model.__data__, {"name": "Lazy"})
+    self.assertEqual(model.slug, "lazy")
+
+    model.get_data()["name"] = "Changed"
+    self.assertEqual(model.get_data()["name"], "Changed")
+
+  def testSame(self):
+    lazy = models.RealTree()
+    lazy.load(dict(self.data), lazy = True)
+    eager = models.RealTree()
+    eager.load(dict(self.data))
+
+    self.assertEqual(lazy.get_errors(), eager.get_errors())
+    self.assertEqual(list(lazy.get_data().items()), list(eager.get_data().items()))
+    self.assertEqual(lazy.to_json(), eager.to_json())
+
+  def testReload(self):
+    model = models.RealTree()
+    model.load(dict(self.data), lazy = True)
+    model.load({"path": "/", "name": "Eager"})
+
+    self.assertEqual(model.get_data(), {"name": "Eager", "path": "/", "slug": "eager"})
+    self.assertIsNone(model.get_errors())
+
+class TestCompact(TestCase):
+  def setUp(self):
+    self.data = [
+      {"path": "/", "name": "First", "elements": ["a"]},
+      {"path": "/", "name": "Second"},
+      {"path": 3, "name": "Third"}
+    ]
+
+  def load(self, compact, batch_load = True):
+    model = models.RealTree(many = True)
+    model.batch_load = batch_load
+    model.load([dict(row) for row in self.data], many = True, compact = compact)
+    return model
+
+  def test(self):
+    compact = self.load(True)
+    loaded = self.load(False)
+
+    self.assertIsInstance(compact.get_data(), Columns)
+    self.assertEqual(compact.get_data(), loaded.get_data())
+    self.assertEqual(compact.get_errors(), loaded.get_errors())
+    self.assertEqual(compact.get_data()[1], {"name": "Second", "path": "/", "slug": "second"})
+    self.assertEqual(compact.get_data().column("elements"), [["a"]])
+    self.assertEqual(len(compact.get_data()), 3)
+
+  def testFallback(self):
+    self.assertIsInstance(self.load(True, False).get_data(), Columns)
+    self.assertEqual(self.load(True, False).get_data(), self.load(False).get_data())
+
+  def testJson(self):
+    compact = self.load(True)
+    compact.json_chunk_size = 2
+
+    self.assertEqual(compact.to_json(), self.load(False).to_json())
+    self.assertEqual(compact.to_plain_dict(), self.load(False).to_plain_dict())
+
+    compact.load([], many = True, compact = True)
+    self.assertEqual(compact.to_json(), "[]")
+
+class TestSlugCache(TestCase):
+  def setUp(self):
+    set_slug_cache_size(2)
+
+  def tearDown(self):
+    set_slug_cache_size(4096)
+
+  def test(self):
+    for name in ["Cached name", "Cached name", "Other name", "Cached name"]:
+      model = models.MinimalTree()
+      model.load({"path": "/", "name": name})
+      self.assertEqual(model.slug, name.lower().replace(" ", "-"))
+
+    info = slug_cache_info()
+    self.assertEqual((info.hits, info.misses, info.maxsize, info.currsize), (2, 2, 2, 2))
+
+    model = models.MinimalTree(many = True)
+    model.load([{"path": "/", "name": "Cached name"}, {"path": "/", "name": "Third name"}], many = True)
+    self.assertEqual([row["slug"] for row in model.get_data()], ["cached-name", "third-name"])
+    self.assertEqual(slug_cache_info().currsize, 2)
+
+  def testTrusted(self):
+    model = models.MinimalTree()
+    model.load({"path": "/", "name": "Trusted", "slug": "stored-slug"}, trusted = True)
+    self.assertEqual(model.slug, "stored-slug")
+    self.assertEqual(slug_cache_info().misses, 0)
+
+    model.load({"path": "/", "name": "Trusted"}, trusted = True)
+    self.assertIn("slug", model.get_errors())
+
+    model.load({"path": "/", "name": "Trusted"})
+    self.assertEqual(model.slug, "trusted")
+
 class TestMinimalTree(TestCase):
   def test(self):
     model = models.MinimalTree()
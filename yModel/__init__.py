@@ -1,21 +1,134 @@
 from json import loads, dumps
-from functools import wraps
+from collections.abc import Mapping
+from functools import wraps, lru_cache
 
-from marshmallow import Schema as mSchema, pre_load, fields
+from marshmallow import Schema as mSchema, pre_load, fields, missing
 from marshmallow.validate import ValidationError
 
 from slugify import slugify
 
+from yModel.batch import BatchLoader, Columns, batch_loadable
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+try:
+  import ujson
+except ImportError:
+  ujson = None
+
+json_backends = {}
+if orjson is not None:
+  json_backends["orjson"] = lambda data: orjson.dumps(data).decode()
+if ujson is not None:
+  json_backends["ujson"] = lambda data: ujson.dumps(data, escape_forward_slashes = False)
+
+PRIMITIVES = (str, int, float, bool, type(None))
+
+def to_plain(value, converters, encoder = None):
+  # the same result as loads(dumps(value, cls = encoder)) without building the intermediate string
+  if value.__class__ in PRIMITIVES:
+    return value
+
+  converter = converters.get(value.__class__)
+  if converter is not None:
+    return converter(value)
+
+  if isinstance(value, dict):
+    return {key if isinstance(key, str) else dumps(key): to_plain(item, converters, encoder) for key, item in value.items()}
+
+  if isinstance(value, (list, tuple)):
+    return [to_plain(item, converters, encoder) for item in value]
+
+  return loads(dumps(value, cls = encoder))
+
+memoized_slugify = lru_cache(maxsize = 4096)(slugify)
+
+def set_slug_cache_size(size):
+  # size 0 disables the memoization, None makes it unbounded
+  global memoized_slugify
+  memoized_slugify = lru_cache(maxsize = size)(slugify)
+
+def slug_cache_info():
+  return memoized_slugify.cache_info()
+
+def make_slug(value):
+  # only strings are memoized: anything else goes to slugify as it is, failing the same way it did
+  return memoized_slugify(value) if value.__class__ is str else slugify(value)
+
+serializers = {}
+prototypes = {}
+batch_loaders = {}
+hydrators = {}
+
+def resolve_model(model, models, cache):
+  # models given by name are looked up once per models container
+  if not isinstance(model, str):
+    return model
+
+  cached = cache.get(id(models))
+  if cached is None or cached[0] is not models:
+    cached = cache[id(models)] = (models, getattr(models, model))
+
+  return cached[1]
+
+def shareable_fields(schema):
+  # Method and Function fields call back into their parent schema, Nested ones bind their own schema to it
+  for field in schema.fields.values():
+    field = getattr(field, "container", field)
+    if isinstance(field, (fields.Method, fields.Function, fields.Nested)):
+      return False
+
+  return True
+
 class Schema(mSchema):
   class Meta:
     ordered = True
 
+  json_backend = None
+  json_chunk_size = 1000
+  batch_load = True
+  trusted_load = False
+
   def __init__(self, table = None, **kwargs):
     super().__init__(**kwargs)
     self.table = table
     self.__data__ = [] if "many" in kwargs and kwargs["many"] else {}
 
+  @classmethod
+  def spawn(cls, table = None, many = None, only = None):
+    # a fresh instance sharing the bound fields of a cached prototype instead of copying and binding them again
+    # schemas with their own __init__ state or fields that reach back to their schema are built as usual
+    if only is not None:
+      # only names the schema doesn't declare aren't cached, the prototypes would grow with whatever callers send
+      if any(name not in cls._declared_fields for name in only):
+        return cls(table, many = many, only = only)
+      only = tuple(name for name in cls._declared_fields if name in only)
+
+    key = (cls, bool(many), only)
+    prototype = prototypes.get(key)
+    if prototype is None:
+      prototype = cls(many = many, only = only)
+      prototypes[key] = prototype = prototype if cls.__init__ is Schema.__init__ and shareable_fields(prototype) else False
+
+    if prototype is False:
+      return cls(table, many = many, only = only)
+
+    instance = cls.__new__(cls)
+    instance.__dict__.update(prototype.__dict__)
+    instance.table = table
+    instance.context = {}
+    instance._types_seen = set()
+    instance.__data__ = [] if many else {}
+    return instance
+
   def __getattr__(self, name):
+    lazy = self.__dict__.get("__lazy__")
+    if lazy and name in lazy:
+      self.resolve(name)
+
     if name in self.__data__:
       return self.__data__[name]
 
@@ -26,39 +139,187 @@ class Schema(mSchema):
     if "type_" in self.fields.keys() and ("type_" not in data or not data["type_"]):
       data["type_"] = self.__class__.__name__
 
-    if "slug" in self.fields.keys() and ("slug" not in data or not data["slug"]):
+    if "slug" in self.fields.keys() and not self.trusted_load and ("slug" not in data or not data["slug"]):
       slugable = self.slugable if hasattr(self, "slugable") else "name"
-      data["slug"] = slugify(data.get(slugable, "")) if isinstance(slugable, str) else slugable(data)
+      data["slug"] = make_slug(data.get(slugable, "")) if isinstance(slugable, str) else slugable(data)
 
     return data
 
-  def load(self, data, many = None, partial = None):
+  def slug_batch(self, rows):
+    # slug_preload for a whole batch, slugifying only the rows that lack a slug
+    if "type_" in self.fields.keys():
+      for row in rows:
+        if not row.get("type_"):
+          row["type_"] = self.__class__.__name__
+
+    if "slug" in self.fields.keys() and not self.trusted_load:
+      pending = [row for row in rows if not row.get("slug")]
+      if pending:
+        slugable = self.slugable if hasattr(self, "slugable") else "name"
+        for row in pending:
+          row["slug"] = make_slug(row.get(slugable, "")) if isinstance(slugable, str) else slugable(row)
+
+  def batch_loader(self):
+    key = (self.__class__, tuple(self.fields.keys()))
+    if key not in batch_loaders:
+      batch_loaders[key] = BatchLoader(self) if BatchLoader.supports(self, (Schema.slug_preload, )) else None
+
+    return batch_loaders[key]
+
+  def load(self, data, many = None, partial = None, trusted = False, lazy = False, compact = False):
+    # trusted: the documents come from the database and already have their slugs, don't compute the missing ones
+    # lazy: keep the raw document and deserialize each field the first time it's read (single documents only)
+    # compact: keep many documents as Columns instead of a list of dicts
+    self.trusted_load = trusted
+    self.__lazy__ = None
+    if lazy and not many and isinstance(data, Mapping):
+      loader = self.batch_loader()
+      if loader is not None:
+        self.slug_batch([data])
+        self.__raw__ = data
+        self.__partial__ = self.partial if partial is None else partial
+        self.__lazy__ = {column[2]: column for column in loader.columns}
+        self.__data__ = {}
+        self.__errors__ = None
+        return
+
+    if many and self.batch_load and batch_loadable(data):
+      loader = self.batch_loader()
+      if loader is not None:
+        self.slug_batch(data)
+        partial = self.partial if partial is None else partial
+        result, errors = loader.load_columns(data, partial) if compact else loader.load(data, partial)
+        self.__data__ = result
+        self.__errors__ = errors or None
+        return
+
     res = super().load(data, many = many, partial = partial)
-    if hasattr(res, "data") and res.data:
-      self.__data__ = list(res.data) if many else dict(res.data)
-    if hasattr(res, "errors") and res.errors:
-      self.__errors__ = dict(res.errors)
+    # reset both so a reused instance doesn't keep the results of a previous load
+    self.__data__ = (list(res.data) if many else dict(res.data)) if res.data else ([] if many else {})
+    self.__errors__ = dict(res.errors) if res.errors else None
+    if many and compact:
+      self.__data__ = self.columns_of(self.__data__)
+
+  def hydrator(self):
+    # loadable keys, missing defaults and required keys of the schema, computed once per class and field set
+    key = (self.__class__, tuple(self.fields.keys()))
+    if key not in hydrators:
+      loadable = [(name, field.attribute or name, field) for name, field in self.fields.items() if not field.dump_only]
+      hydrators[key] = (
+        frozenset(attribute for name, attribute, field in loadable),
+        [(attribute, field.missing) for name, attribute, field in loadable if field.missing is not missing],
+        [(name, attribute, field.error_messages["required"]) for name, attribute, field in loadable if field.required]
+      )
+
+    return hydrators[key]
+
+  @staticmethod
+  def hydrate_one(doc, hydrator, check):
+    keys, defaults, required = hydrator
+    absent = [(key, default) for key, default in defaults if key not in doc]
+    if absent or not doc.keys() <= keys:
+      doc = {key: value for key, value in doc.items() if key in keys}
+      for key, default in absent:
+        doc[key] = default() if callable(default) else default
+
+    errors = {name: [message] for name, key, message in required if key not in doc} if check else None
+    return doc, errors
+
+  def columns_of(self, rows):
+    return Columns.from_rows(rows, [field.attribute or name for name, field in self.fields.items() if not field.dump_only])
+
+  def hydrate(self, data, many = None, check = False, compact = False):
+    # trusted data (our own collection): no deserialization nor validation, only the schema keys and defaults
+    # check only looks for the required keys
+    hydrator = self.hydrator()
+    self.__lazy__ = None
+    if many:
+      self.__data__ = []
+      errors = {}
+      for index, doc in enumerate(data):
+        doc, doc_errors = self.hydrate_one(doc, hydrator, check)
+        self.__data__.append(doc)
+        if doc_errors:
+          errors[index] = doc_errors
+    else:
+      self.__data__, errors = self.hydrate_one(data, hydrator, check)
+
+    self.__errors__ = errors or None
+    if many and compact:
+      self.__data__ = self.columns_of(self.__data__)
+
+  def resolve(self, key = None):
+    # deserializes the pending field key (all of them when None) of a lazy load
+    lazy = self.__lazy__
+    columns = [lazy.pop(key)] if key is not None else [lazy.pop(key) for key in list(lazy)]
+    errors = {}
+    for column in columns:
+      value = BatchLoader.load_column(column, [self.__raw__], errors, self.__partial__)[0]
+      if value is not missing:
+        self.__data__[column[2]] = value
+
+    if errors:
+      self.__errors__ = dict(self.__errors__ or {}, **errors[0])
+
+    if not lazy:
+      # same key order as an eager load
+      order = self.batch_loader().columns
+      self.__data__ = {column[2]: self.__data__[column[2]] for column in order if column[2] in self.__data__}
+      self.__lazy__ = None
+      self.__raw__ = None
 
   def get_data(self):
+    if self.__dict__.get("__lazy__"):
+      self.resolve()
+
     return self.__data__
 
   def get_errors(self):
+    if self.__dict__.get("__lazy__"):
+      self.resolve()
+
     return getattr(self, "__errors__", None)
 
+  @classmethod
+  def serializer(cls, exclude = None):
+    key = (cls, frozenset(exclude or ()))
+    if key not in serializers:
+      excluded = key[1]
+      encoder = getattr(cls, "encoder", None)
+      converters = getattr(encoder, "converters", {})
+
+      def serialize(element):
+        return {name: to_plain(value, converters, encoder) for name, value in element.items() if name not in excluded}
+
+      serializers[key] = serialize
+
+    return serializers[key]
+
+  def to_plain_dict(self, exclude = None):
+    if exclude is None and hasattr(self, "exclusions"):
+      exclude = self.exclusions
+
+    serialize = self.serializer(exclude)
+    data = self.get_data()
+    return [serialize(element) for element in data] if isinstance(data, (list, Columns)) else serialize(data)
+
   def to_json(self, exclude = None):
-    data = self.get_data().copy()
+    encode = json_backends.get(self.json_backend, dumps)
+    data = self.get_data()
+    if not isinstance(data, Columns):
+      return encode(self.to_plain_dict(exclude))
+
+    # json_chunk_size rows at a time so the whole list of dicts never exists at once
     if exclude is None and hasattr(self, "exclusions"):
       exclude = self.exclusions
-    if exclude:
-      for element in data if isinstance(data, list) else [data]:
-        for member in exclude:
-          if member in element:
-            del element[member]
 
-    return dumps(data, cls = self.encoder) if hasattr(self, "encoder") else dumps(data)
+    serialize = self.serializer(exclude)
+    separator = ", " if encode is dumps else ","
+    chunks = []
+    for start in range(0, len(data), self.json_chunk_size):
+      chunks.append(encode([serialize(row) for row in data.rows(start, start + self.json_chunk_size)])[1:-1])
 
-  def to_plain_dict(self, exclude = None):
-    return loads(self.to_json(exclude))
+    return "[{}]".format(separator.join(chunks))
 
 class Tree():
   def children_of_type(self, type_):
@@ -92,6 +353,7 @@ def consumes(model, many = None, from_ = "json", getter = None, description = No
     if not hasattr(func, "__decorators__"):
       func.__decorators__ = {}
     func.__decorators__["consumes"] = {"model": model, "many": many, "from": from_, "getter": getter, "description": description}
+    resolved = {}
 
     @wraps(func)
     async def decorated(*args, **kwargs):
@@ -104,7 +366,7 @@ def consumes(model, many = None, from_ = "json", getter = None, description = No
       if request is None:
         raise InvalidRoute(func.__name__)
 
-      modelObj = (getattr(request.app.models, model) if isinstance(model, str) else model)(many = many)
+      modelObj = resolve_model(model, request.app.models, resolved).spawn(many = many)
       payload = getter(getattr(request, from_)) if getter else getattr(request, from_)
       modelObj.load(payload, many = many)
       errors = modelObj.get_errors()
@@ -126,6 +388,7 @@ def produces(model, many = None, as_ = None, renderer = None, description = None
     if not hasattr(func, "__decorators__"):
       func.__decorators__ = {}
     func.__decorators__["produces"] = {"model": model, "many": many, "as_": as_, "renderer": renderer, "description": description}
+    resolved = {}
 
     @wraps(func)
     async def decorated(*args, **kwargs):
@@ -140,7 +403,7 @@ def produces(model, many = None, as_ = None, renderer = None, description = None
 
       result = await func(*args, **kwargs)
 
-      modelObj = (getattr(request.app.models, model) if isinstance(model, str) else model)(many = many)
+      modelObj = resolve_model(model, request.app.models, resolved).spawn(many = many)
       if as_ is not None:
         data = {}
         data[as_] = result
@@ -178,7 +441,7 @@ def can_crash(exc, model = ErrorSchema, getter = "__str__", code = 400, renderer
         result = await func(*args, **kwargs)
         return result
       except exc as e:
-        modelObj = model()
+        modelObj = model.spawn()
         getterMember = getattr(e, getter)
         message = getterMember() if callable(getterMember) else getterMember
         modelObj.load({"message": message, "code": code})
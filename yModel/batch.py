@@ -0,0 +1,150 @@
+from collections.abc import Mapping
+
+from marshmallow import fields, missing, ValidationError
+from marshmallow.decorators import PRE_LOAD
+from marshmallow.marshalling import FIELD
+from marshmallow.schema import BaseSchema
+
+# values of these exact classes come out of the field's deserialization untouched when it has no validators
+PASSTHROUGH = {
+  fields.String: (str, ),
+  fields.Integer: (int, ),
+  fields.Float: (float, ),
+  fields.Boolean: (bool, )
+}
+
+def passthrough(field):
+  return () if field.validators else PASSTHROUGH.get(field.__class__, ())
+
+class BatchLoader():
+  # column oriented equivalent of marshmallow's many=True load for schemas without custom hooks
+  def __init__(self, schema):
+    self.columns = []
+    for name, field in schema.fields.items():
+      if not field.dump_only:
+        self.columns.append((name, field.load_from, field.attribute or name, field, frozenset(passthrough(field))))
+
+  @staticmethod
+  def supports(schema, preloads = ()):
+    # preloads: the pre_load hooks the caller runs by itself over the whole batch
+    if schema.strict or not schema.opts.index_errors or type(schema).handle_error is not BaseSchema.handle_error:
+      return False
+
+    for tag, names in schema.__processors__.items():
+      if tag == (PRE_LOAD, False):
+        if any(getattr(type(schema), name) not in preloads for name in names):
+          return False
+      elif names:
+        return False
+
+    return all("." not in (field.attribute or "") for field in schema.fields.values())
+
+  def load(self, rows, partial = None):
+    data = [{} for row in rows]
+    errors = {}
+    for column in self.columns:
+      key = column[2]
+      for row, value in zip(data, self.load_column(column, rows, errors, partial)):
+        if value is not missing:
+          row[key] = value
+
+    return data, errors
+
+  def load_columns(self, rows, partial = None):
+    errors = {}
+    columns = {column[2]: self.load_column(column, rows, errors, partial) for column in self.columns}
+    return Columns(columns, len(rows)), errors
+
+  @staticmethod
+  def load_column(column, rows, errors, partial = None):
+    # the loaded values of a field, one per row (missing where the row won't have it)
+    name, load_from, key, field, fast = column
+    allowed_missing = partial is True or (isinstance(partial, (list, tuple, set, frozenset)) and name in partial)
+    values = [missing] * len(rows)
+    for index, row in enumerate(rows):
+      value = row.get(name, missing)
+      if value.__class__ in fast:
+        values[index] = value
+        continue
+
+      field_name = name
+      if value is missing and load_from:
+        field_name = load_from
+        value = row.get(load_from, missing)
+        if value.__class__ in fast:
+          values[index] = value
+          continue
+
+      if value is missing:
+        if allowed_missing:
+          continue
+
+        value = field.missing() if callable(field.missing) else field.missing
+        if value is missing and not field.required:
+          continue
+
+      try:
+        values[index] = field.deserialize(value, load_from or name, row)
+      except ValidationError as err:
+        row_errors = errors.setdefault(index, {})
+        if isinstance(err.messages, dict):
+          row_errors[field_name] = err.messages
+        elif isinstance(row_errors.get(field_name), dict):
+          row_errors[field_name].setdefault(FIELD, []).extend(err.messages)
+        else:
+          row_errors.setdefault(field_name, []).extend(err.messages)
+        values[index] = err.data or missing
+
+    return values
+
+class Columns():
+  # many documents stored as one list per field instead of one dict per document
+  # rows are rebuilt as dicts only while they're being read
+  __slots__ = ("columns", "length")
+
+  def __init__(self, columns, length):
+    self.columns = columns
+    self.length = length
+
+  @classmethod
+  def from_rows(cls, rows, keys):
+    return cls({key: [row.get(key, missing) for row in rows] for key in keys}, len(rows))
+
+  def row(self, index):
+    return {key: values[index] for key, values in self.columns.items() if values[index] is not missing}
+
+  def rows(self, start = 0, stop = None):
+    for index in range(start, self.length if stop is None else min(stop, self.length)):
+      yield self.row(index)
+
+  def column(self, key):
+    return [value for value in self.columns.get(key, ()) if value is not missing]
+
+  def __len__(self):
+    return self.length
+
+  def __iter__(self):
+    return self.rows()
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self.row(position) for position in range(*index.indices(self.length))]
+
+    if index < 0:
+      index += self.length
+    if not 0 <= index < self.length:
+      raise IndexError("Columns index out of range")
+
+    return self.row(index)
+
+  def __contains__(self, item):
+    return isinstance(item, Mapping) and any(row == item for row in self)
+
+  def __eq__(self, other):
+    if isinstance(other, (Columns, list, tuple)):
+      return len(self) == len(other) and all(row == item for row, item in zip(self, other))
+
+    return NotImplemented
+
+def batch_loadable(rows):
+  return isinstance(rows, (list, tuple)) and all(isinstance(row, Mapping) for row in rows)
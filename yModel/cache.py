@@ -0,0 +1,195 @@
+from asyncio import ensure_future
+from collections import OrderedDict
+from time import monotonic
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+CHANGE_STREAM_HISTORY_LOST = 286
+
+def node_url(doc):
+  path = doc.get("path")
+  if path == "":
+    return "/"
+
+  return "/{}".format(doc.get("slug")) if path == "/" else "{}/{}".format(path, doc.get("slug"))
+
+class NodeCache():
+  def __init__(self, maxsize = 1024, ttl = 60):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.docs = OrderedDict()
+    self.paths = {}
+    self.hits = 0
+    self.misses = 0
+
+  @staticmethod
+  def path_key(path, slug = None):
+    # the root is the only document with an empty path so its slug doesn't take part in the key
+    return (path, slug if path else None)
+
+  def get(self, _id):
+    entry = self.docs.get(_id)
+    if entry is None:
+      self.misses += 1
+      return None
+
+    expires, doc = entry
+    if self.ttl is not None and expires < monotonic():
+      self.evict(_id)
+      self.misses += 1
+      return None
+
+    self.docs.move_to_end(_id)
+    self.hits += 1
+    return dict(doc)
+
+  def peek(self, _id):
+    entry = self.docs.get(_id)
+    return entry[1] if entry is not None else None
+
+  def get_path(self, path, slug = None):
+    _id = self.paths.get(self.path_key(path, slug))
+    if _id is None:
+      self.misses += 1
+      return None
+
+    return self.get(_id)
+
+  def put(self, doc):
+    self.evict(doc["_id"])
+    self.docs[doc["_id"]] = (monotonic() + self.ttl if self.ttl is not None else None, dict(doc))
+    self.paths[self.path_key(doc.get("path"), doc.get("slug"))] = doc["_id"]
+
+    while len(self.docs) > self.maxsize:
+      self.evict(next(iter(self.docs)))
+
+  def evict(self, _id):
+    entry = self.docs.pop(_id, None)
+    if entry is not None:
+      key = self.path_key(entry[1].get("path"), entry[1].get("slug"))
+      if self.paths.get(key) == _id:
+        del self.paths[key]
+
+  def invalidate(self, _id = None, path = None, slug = None):
+    if _id is not None:
+      self.evict(_id)
+
+    if path is not None:
+      _id = self.paths.get(self.path_key(path, slug))
+      if _id is not None:
+        self.evict(_id)
+
+  def invalidate_subtree(self, url):
+    prefix = "/" if url == "/" else url + "/"
+    for _id, (expires, doc) in list(self.docs.items()):
+      path = doc.get("path") or ""
+      if path == url or path.startswith(prefix):
+        self.evict(_id)
+
+  def clear(self):
+    self.docs.clear()
+    self.paths.clear()
+
+  def stats(self):
+    return {"hits": self.hits, "misses": self.misses, "size": len(self.docs), "maxsize": self.maxsize, "ttl": self.ttl}
+
+class MemoryTokenStore():
+  def __init__(self):
+    self.token = None
+
+  async def load(self):
+    return self.token
+
+  async def save(self, token):
+    self.token = token
+
+class MongoTokenStore():
+  def __init__(self, table, name):
+    self.table = table
+    self.name = name
+
+  async def load(self):
+    doc = await self.table.find_one({"_id": self.name})
+    return doc["token"] if doc else None
+
+  async def save(self, token):
+    await self.table.update_one({"_id": self.name}, {"$set": {"token": token}}, upsert = True)
+
+class ChangeStreamInvalidator():
+  # evicts the documents other processes change on table from cache
+  # when change streams aren't available (standalone mongod) or the stream dies, the cache is cleared and only the ttl keeps it fresh
+  def __init__(self, table, cache, store = None, save_every = 1):
+    self.table = table
+    self.cache = cache
+    self.store = store or MemoryTokenStore()
+    self.save_every = save_every
+    self.active = False
+    self.error = None
+    self.task = None
+
+  def apply(self, change):
+    operation = change["operationType"]
+    if operation in ("insert", "update", "replace", "delete"):
+      _id = change["documentKey"]["_id"]
+      cached = self.cache.peek(_id)
+      if operation == "update" and cached is not None:
+        description = change.get("updateDescription", {})
+        changed = set(description.get("updatedFields", {})) | set(description.get("removedFields", []))
+        if changed & {"path", "slug"}:
+          self.cache.invalidate_subtree(node_url(cached))
+
+      if operation == "insert":
+        doc = change.get("fullDocument") or {}
+        self.cache.invalidate(path = doc.get("path"), slug = doc.get("slug"))
+
+      self.cache.invalidate(_id)
+    else:
+      # drop, rename, dropDatabase and invalidate
+      self.cache.clear()
+
+  async def run(self):
+    token = await self.store.load()
+    while True:
+      try:
+        async with self.table.watch(resume_after = token) as stream:
+          self.active = True
+          seen = 0
+          async for change in stream:
+            self.apply(change)
+            seen += 1
+            if seen % self.save_every == 0:
+              await self.store.save(stream.resume_token)
+
+            if change["operationType"] == "invalidate":
+              token = None
+              break
+          else:
+            return
+      except OperationFailure as e:
+        self.cache.clear()
+        if e.code == CHANGE_STREAM_HISTORY_LOST and token is not None:
+          token = None
+          continue
+
+        self.active = False
+        self.error = e
+        return
+      except PyMongoError as e:
+        self.cache.clear()
+        self.active = False
+        self.error = e
+        return
+
+  def start(self):
+    self.task = ensure_future(self.run())
+    return self.task
+
+  async def stop(self):
+    if self.task is not None:
+      self.task.cancel()
+      try:
+        await self.task
+      except BaseException:
+        pass
+
+    self.active = False
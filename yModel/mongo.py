@@ -1,15 +1,23 @@
+from asyncio import gather
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from datetime import datetime
 from json import dumps, JSONEncoder
 from pathlib import PurePath
 import decimal
+import re
 
 import bson
-from pymongo.errors import InvalidOperation, DuplicateKeyError
+from bson import json_util
+from pymongo import ASCENDING, DESCENDING, ReadPreference, UpdateMany, UpdateOne
+from pymongo.read_concern import ReadConcern
+from pymongo.write_concern import WriteConcern
+from pymongo.errors import BulkWriteError, InvalidOperation, DuplicateKeyError, PyMongoError, WriteError
 
 from marshmallow import fields, ValidationError, missing
 from marshmallow.validate import Range
 
 from yModel import Schema, Tree
+from yModel.cache import node_url
 
 class ObjectId(fields.Field):
   def _deserialize(self, value, attr, data):
@@ -59,11 +67,17 @@ class DateTime(fields.Field):
     return value if isinstance(value, str) else value.isoformat()
 
 class MongoJSONEncoder(JSONEncoder):
+  converters = {
+    bson.ObjectId: str,
+    bson.decimal128.Decimal128: str,
+    decimal.Decimal: str,
+    datetime: lambda obj: obj.isoformat(timespec = 'milliseconds')
+  }
+
   def default(self, obj):
-    if isinstance(obj, (bson.ObjectId, bson.decimal128.Decimal128, decimal.Decimal)):
-      return str(obj)
-    elif isinstance(obj, datetime):
-      return obj.isoformat(timespec = 'milliseconds')
+    for type_, converter in self.converters.items():
+      if isinstance(obj, type_):
+        return converter(obj)
 
     return JSONEncoder.default(self, obj)
 
@@ -77,10 +91,183 @@ class URIAlreadyExists(Exception):
   def __str__(self):
     return dumps({self.field:["This {} is already used at this level".format(self.field)]})
 
+def subtree_query(url, max_depth = None):
+  # everything under url: its children (path == url) and deeper descendants (path starting with url/)
+  # an escaped, left anchored regex lets mongo turn it into bounded scans on the path index
+  # max_depth: 1 for the children only, 2 for the grandchildren too...
+  if max_depth is not None:
+    if max_depth < 1:
+      raise ValidationError("max_depth must be at least 1")
+
+    if max_depth == 1:
+      return {"path": url}
+
+    if url == "/":
+      return {"path": {"$regex": "^/([^/]+(/[^/]+){{0,{}}})?$".format(max_depth - 2)}}
+
+    return {"path": {"$regex": "^{}(/[^/]+){{0,{}}}$".format(re.escape(url), max_depth - 1)}}
+
+  if url == "/":
+    return {"path": {"$regex": "^/"}}
+
+  return {"$or": [{"path": url}, {"path": {"$regex": "^{}".format(re.escape(url + "/"))}}]}
+
+def page_token(key, doc):
+  # opaque continuation token: the sort key value and _id of the last document of the page
+  token = json_util.dumps({"key": key, "value": doc.get(key), "_id": doc["_id"]})
+  return urlsafe_b64encode(token.encode()).decode()
+
+def page_order(sort, default = ("_id", ASCENDING)):
+  # the (key, direction) of a paged query from any of the sort forms get and children take: "key", (key, direction),
+  # [(key, direction)], {key: direction} or {"$sort": {key: direction}}. _id is always the tie breaker so it can only follow the key
+  if not sort:
+    return default
+
+  if isinstance(sort, str):
+    return sort, ASCENDING
+
+  if isinstance(sort, tuple) and len(sort) == 2 and isinstance(sort[0], str) and isinstance(sort[1], int):
+    return sort
+
+  if isinstance(sort, dict):
+    sort = list(sort.get("$sort", sort).items())
+
+  if not all(isinstance(item, (list, tuple)) and len(item) == 2 and isinstance(item[0], str) for item in sort):
+    raise ValidationError("invalid sort `{}`".format(sort))
+
+  if len(sort) == 2 and sort[1][0] == "_id" and sort[0][0] != "_id":
+    sort = sort[:1]
+  if len(sort) != 1:
+    raise ValidationError("pages are sorted by a single key (and _id), not `{}`".format(sort))
+
+  return tuple(sort[0])
+
+def keyset_query(token, key, direction = ASCENDING):
+  try:
+    after = json_util.loads(urlsafe_b64decode(token.encode()).decode())
+  except Exception:
+    raise ValidationError("invalid page token `{}`".format(token))
+
+  if after.get("key") != key:
+    raise ValidationError("the page token doesn't belong to a {} sorted query".format(key))
+
+  operator = "$gt" if direction == ASCENDING else "$lt"
+  if key == "_id":
+    return {"_id": {operator: after["_id"]}}
+
+  # null and missing values sort before any other and comparison operators never match them
+  ties = {key: after["value"], "_id": {operator: after["_id"]}}
+  if after["value"] is None:
+    return {"$or": [{key: {"$ne": None}}, ties]} if direction == ASCENDING else ties
+
+  if direction == ASCENDING:
+    return {"$or": [{key: {operator: after["value"]}}, ties]}
+
+  return {"$or": [{key: {operator: after["value"]}}, ties, {key: None}]}
+
+RANK_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def rank_between(before = None, after = None):
+  # a key sorting strictly between before and after (None: no bound), it never ends in 0 so there's always room before it
+  for key in (before, after):
+    if key is not None and (not key or key.endswith("0") or any(digit not in RANK_DIGITS for digit in key)):
+      raise ValidationError("`{}` isn't a rank".format(key))
+
+  if before is not None and after is not None and before >= after:
+    raise ValidationError("`{}` doesn't sort before `{}`".format(before, after))
+
+  before = before or ""
+  rank = ""
+  position = 0
+  while True:
+    low = RANK_DIGITS.index(before[position]) if position < len(before) else 0
+    high = RANK_DIGITS.index(after[position]) if after is not None else len(RANK_DIGITS)
+    if high - low > 1:
+      return rank + RANK_DIGITS[(low + high) // 2]
+
+    rank += RANK_DIGITS[low]
+    if high - low == 1:
+      after = None
+    position += 1
+
+def ranks_between(before, after, count):
+  # count increasing keys between before and after, bisecting so their length only grows with log(count)
+  if count <= 0:
+    return []
+
+  middle = rank_between(before, after)
+  left = (count - 1) // 2
+  return ranks_between(before, middle, left) + [middle] + ranks_between(middle, after, count - 1 - left)
+
+WRITE_POLICIES = ("transaction", "bulk", "single")
+
+def negated(inc):
+  return {key: -value for key, value in inc.items()}
+
+def restoring(previous, keys):
+  # the update that puts back the previous values of keys, unsetting the ones that weren't there
+  update = {}
+  if previous:
+    update["$set"] = dict(previous)
+  if set(keys) - set(previous):
+    update["$unset"] = dict.fromkeys(set(keys) - set(previous), 1)
+  return update
+
 class MongoSchema(Schema):
   encoder = MongoJSONEncoder
+  stream_batch_size = 100
+  page_size = 20
+  insert_chunk_size = 1000
+  auto_projection = True
+  project_exclusions = False
+  trusted_reads = False
+  # reads go through these when set (pymongo read preferences, read concerns or their level): SecondaryPreferred(max_staleness = 90), "majority"...
+  read_preference = None
+  read_concern = None
+  # get's keyword arguments that aren't part of the query
+  read_options = ("sort", "many", "limit", "projection", "trusted", "lazy", "compact", "read_preference", "read_concern")
+
+  def projection(self):
+    # only the fields this schema (or its only/exclude subset) is going to load
+    # documents keep the loaded data (under attribute or name) but can come with the load_from key too
+    exclusions = (getattr(self, "exclusions", None) or ()) if self.project_exclusions else ()
+    projection = {}
+    for name, field in self.fields.items():
+      if name not in exclusions or field.required:
+        projection.update(dict.fromkeys(key for key in (name, field.attribute, field.load_from) if key))
+
+    return dict.fromkeys(projection, 1)
+
+  def resolve_projection(self, projection = None):
+    if projection is None:
+      projection = self.auto_projection
+
+    if projection is True:
+      return self.projection()
+
+    return projection or None
+
+  def reader(self, read_preference = None, read_concern = None):
+    # the collection the reads go through, the per call options override the class ones
+    options = {}
+    read_preference = read_preference or self.read_preference
+    if read_preference is not None:
+      options["read_preference"] = read_preference
+
+    read_concern = read_concern or self.read_concern
+    if read_concern is not None:
+      options["read_concern"] = ReadConcern(read_concern) if isinstance(read_concern, str) else read_concern
+
+    return self.table.with_options(**options) if options else self.table
+
+  def read(self, data, many = None, trusted = None, lazy = False, compact = False):
+    # documents read from our own collection are hydrated as they are when trusted (trusted_reads by default)
+    if self.trusted_reads if trusted is None else trusted:
+      self.hydrate(data, many, check = True, compact = compact)
+    else:
+      self.load(data, many, lazy = lazy, compact = compact)
 
-  async def create(self):
+  async def create(self, session = None):
     if not self.table:
       raise InvalidOperation("No table")
 
@@ -88,7 +275,7 @@ class MongoSchema(Schema):
     if not data:
       raise InvalidOperation("No data")
 
-    result = await self.table.insert_one(data)
+    result = await self.table.insert_one(data, session = session)
 
     if hasattr(self, "__post_create__"):
       await self.__post_create__()
@@ -96,6 +283,60 @@ class MongoSchema(Schema):
     if result.inserted_id:
       self.__data__["_id"] = result.inserted_id
 
+  @classmethod
+  def write_error(cls, doc, error):
+    if error.get("code") == 11000:
+      return DuplicateKeyError(error.get("errmsg"), 11000, error)
+
+    return WriteError(error.get("errmsg"), error.get("code"), error)
+
+  @classmethod
+  async def create_many(cls, table, data, chunk_size = None):
+    # returns a many schema with the inserted documents and the errors by position in data
+    if not table:
+      raise InvalidOperation("No table")
+
+    if not data:
+      raise InvalidOperation("No data")
+
+    pending, errors = cls.load_many(table, data)
+    model = await cls.insert_loaded(table, pending, errors, chunk_size)
+    return model, errors
+
+  @classmethod
+  def load_many(cls, table, data):
+    # the (position, document) pairs of data that are valid and the errors of the rest
+    model = cls.spawn(table, many = True)
+    model.load(data, many = True, partial = ("_id", ))
+    errors = dict(model.get_errors() or {})
+    return [(index, doc) for index, doc in enumerate(model.get_data()) if index not in errors], errors
+
+  @classmethod
+  async def insert_loaded(cls, table, pending, errors, chunk_size = None, session = None):
+    # inserts the documents of load_many, adding the write errors to errors, and returns a many schema with the inserted ones
+    chunk_size = chunk_size or cls.insert_chunk_size
+    for start in range(0, len(pending), chunk_size):
+      chunk = pending[start:start + chunk_size]
+      try:
+        await table.insert_many([doc for index, doc in chunk], ordered = False, session = session)
+      except BulkWriteError as e:
+        for error in e.details.get("writeErrors", []):
+          index, doc = chunk[error["index"]]
+          errors[index] = cls.write_error(doc, error)
+
+    model = cls.spawn(table, many = True)
+    model.__data__ = [doc for index, doc in pending if index not in errors]
+
+    if hasattr(model, "__post_create_many__"):
+      await model.__post_create_many__()
+    elif hasattr(cls, "__post_create__"):
+      for doc in model.get_data():
+        created = cls.spawn(table)
+        created.__data__ = doc
+        await created.__post_create__()
+
+    return model
+
   async def get(self, **kwargs):
     if not self.table:
       raise InvalidOperation("No table")
@@ -104,33 +345,104 @@ class MongoSchema(Schema):
     sort = kwargs.pop("sort", None)
     many = kwargs.pop("many", False)
     limit = kwargs.pop("limit", None)
+    projection = self.resolve_projection(kwargs.pop("projection", None))
+    trusted = kwargs.pop("trusted", None)
+    lazy = kwargs.pop("lazy", False)
+    compact = kwargs.pop("compact", False)
+    table = self.reader(kwargs.pop("read_preference", None), kwargs.pop("read_concern", None))
 
     if many:
-      data = await self.table.find(query).sort(sort).to_list(limit) if sort else await self.table.find(query).to_list(limit)
+      data = await table.find(query, projection).sort(sort).to_list(limit) if sort else await table.find(query, projection).to_list(limit)
     else:
       if sort:
-        docs = await self.table.find(query).sort(sort).to_list(1)
+        docs = await table.find(query, projection).sort(sort).to_list(1)
         data = docs[0] if docs else None
       else:
-        data = await self.table.find_one(query)
+        data = await table.find_one(query, projection)
 
     # data = await self.table.find(query).to_list(limit) if many else await self.table.find_one(query)
     if not data:
       raise NotFound(query)
 
-    self.load(data, many)
+    self.read(data, many, trusted, lazy, compact)
+
+  async def stream(self, **kwargs):
+    if not self.table:
+      raise InvalidOperation("No table")
+
+    query = kwargs.pop("query", kwargs)
+    sort = kwargs.pop("sort", None)
+    limit = kwargs.pop("limit", None)
+    projection = self.resolve_projection(kwargs.pop("projection", None))
+    batch_size = kwargs.pop("batch_size", None) or self.stream_batch_size
+    trusted = kwargs.pop("trusted", None)
+    table = self.reader(kwargs.pop("read_preference", None), kwargs.pop("read_concern", None))
+
+    cursor = table.find(query, projection, batch_size = batch_size)
+    if sort:
+      cursor = cursor.sort(sort)
+    if limit:
+      cursor = cursor.limit(limit)
+
+    async for batch in self.batches(cursor, self.__class__, batch_size, trusted):
+      yield batch
+
+  async def batches(self, cursor, model_class, batch_size, trusted = None):
+    # validates the documents batch_size at a time while the cursor is being consumed
+    docs = []
+    try:
+      async for doc in cursor:
+        docs.append(doc)
+        if len(docs) >= batch_size:
+          batch = model_class.spawn(self.table, many = True)
+          batch.read(docs, True, trusted)
+          docs = []
+          yield batch
+
+      if docs:
+        batch = model_class.spawn(self.table, many = True)
+        batch.read(docs, True, trusted)
+        yield batch
+    finally:
+      await cursor.close()
+
+  async def page(self, **kwargs):
+    if not self.table:
+      raise InvalidOperation("No table")
+
+    query = kwargs.pop("query", kwargs)
+    limit = kwargs.pop("limit", None) or self.page_size
+    after = kwargs.pop("after", None)
+    key, direction = page_order(kwargs.pop("sort", None))
+    projection = self.resolve_projection(kwargs.pop("projection", None))
+    trusted = kwargs.pop("trusted", None)
+    compact = kwargs.pop("compact", False)
+    table = self.reader(kwargs.pop("read_preference", None), kwargs.pop("read_concern", None))
 
-  async def update(self, data = None):
+    if after:
+      query = {"$and": [query, keyset_query(after, key, direction)]}
+    if projection:
+      projection = dict(projection, **{key: 1})
+    sort = [(key, direction)] if key == "_id" else [(key, direction), ("_id", direction)]
+
+    docs = await table.find(query, projection).sort(sort).limit(limit + 1).to_list(limit + 1)
+
+    self.__data__ = []
+    self.read(docs[:limit], True, trusted, compact = compact)
+
+    return page_token(key, docs[limit - 1]) if len(docs) > limit else None
+
+  async def update(self, data = None, session = None):
     if not self.table:
       raise InvalidOperation("No table")
 
-    if "_id" not in self.__data__:
+    if "_id" not in self.get_data():
       raise InvalidOperation("The object hasn't been saved {}".format(self.get_data()))
 
     if data is None:
       data = self.get_data().copy()
 
-    model = self.__class__(self.table, only = tuple(data.keys()))
+    model = self.spawn(self.table, only = tuple(data.keys()))
     model.load(data)
     errors = model.get_errors()
     if errors:
@@ -139,11 +451,53 @@ class MongoSchema(Schema):
     if "_id" in data:
       del data["_id"]
 
-    result = self.table.update_one({"_id": self._id}, {"$set": data})
+    await self.table.update_one({"_id": self._id}, {"$set": data}, session = session)
     self.__data__.update(data)
 
     return model
 
+  @classmethod
+  async def bulk_update(cls, table, updates, upsert = False, ordered = True):
+    # updates are data dicts with their _id or (query, data) pairs, validated like update does
+    if not table:
+      raise InvalidOperation("No table")
+
+    validators = {}
+    requests = []
+    errors = {}
+    refused = cls.bulk_refused()
+    for index, update in enumerate(updates):
+      if isinstance(update, dict) and "_id" not in update:
+        errors[index] = {"_id": ["Missing data for required field."]}
+        continue
+
+      query, data = ({"_id": update["_id"]}, update) if isinstance(update, dict) else update
+      keys = tuple(sorted(data.keys()))
+      if keys not in validators:
+        validators[keys] = cls.spawn(table, only = keys)
+
+      validators[keys].load(data)
+      row_errors = dict(validators[keys].get_errors() or {})
+      row_errors.update({key: ["Can't be changed by bulk_update"] for key in keys if key in refused})
+      if row_errors:
+        errors[index] = row_errors
+      else:
+        requests.append(UpdateOne(query, {"$set": {key: value for key, value in data.items() if key != "_id"}}, upsert = upsert))
+
+    if errors:
+      raise ValidationError(errors)
+
+    if not requests:
+      return {"matched": 0, "modified": 0, "upserted": 0}
+
+    result = await table.bulk_write(requests, ordered = ordered)
+    return {"matched": result.matched_count, "modified": result.modified_count, "upserted": result.upserted_count}
+
+  @classmethod
+  def bulk_refused(cls):
+    # the keys bulk_update doesn't write because other documents depend on them
+    return ()
+
   async def remove_field(self, field):
     if not self.table:
       raise InvalidOperation("No table")
@@ -152,38 +506,296 @@ class MongoSchema(Schema):
       raise InvalidOperation("The object hasn't been saved {}".format(self.get_data()))
 
     await self.table.update_one({"_id": self._id}, {"$unset": {field: 1}})
-    del self.__data__[field]
+    del self.get_data()[field]
 
-  async def delete(self):
+  async def delete(self, session = None):
     if not self.table:
       raise InvalidOperation("No table")
 
     if not self._id:
       raise InvalidOperation("The object hasn't been saved {}".format(self.get_data()))
 
-    await self.table.delete_one({"_id": self._id})
+    await self.table.delete_one({"_id": self._id}, session = session)
 
 class MongoTree(MongoSchema, Tree):
-  async def create(self):
+  bulk_size = 1000
+  cache = None
+  # maintained children counts (per member), descendants count and sums of aggregate_sums over the descendants
+  aggregates = False
+  aggregate_sums = ()
+  # "array": children follow the order of the parent's member array, "rank": their own _rank keys
+  order_strategy = "array"
+  # how the writes of create_child(ren), update, move and delete go together, one of WRITE_POLICIES:
+  # "transaction": a multi-document transaction (replica sets and sharded clusters only)
+  # "bulk": one after the other, reverting the ones already made when a later one fails
+  # "single": one after the other, each single-document write on its own
+  write_policy = "transaction"
+  # WriteConcern or its arguments ({"w": "majority", "j": True}), every tree write accepts its own
+  write_concern = None
+
+  _aggregates = fields.Dict()
+  _rank = fields.Str()
+
+  async def create(self, session = None):
+    # a new node has no subtree, whatever _aggregates it was loaded with
+    self.get_data().pop("_aggregates", None)
     try:
-      await super().create()
+      await super().create(session)
     except DuplicateKeyError:
       raise URIAlreadyExists(self.get_url())
 
-  async def ancestors(self, models, parent = False, check = None):
+    self.uncache()
+
+  @classmethod
+  def write_error(cls, doc, error):
+    if error.get("code") == 11000:
+      node = cls.spawn()
+      node.__data__ = doc
+      return URIAlreadyExists(node.get_url())
+
+    return super().write_error(doc, error)
+
+  @classmethod
+  def load_many(cls, table, data):
+    # ranks are given by the parent
+    pending, errors = super().load_many(table, data)
+    for index, doc in pending:
+      doc.pop("_aggregates", None)
+      doc.pop("_rank", None)
+
+    return pending, errors
+
+  @classmethod
+  def bulk_refused(cls):
+    # paths, indexes, ranks and aggregates are kept by update, create_child, move and reorder
+    return ("slug", "path", "_aggregates", "_rank") + (tuple(cls.aggregate_sums) if cls.aggregates else ())
+
+  @classmethod
+  async def bulk_update(cls, table, updates, upsert = False, ordered = True):
+    counts = await super().bulk_update(table, updates, upsert, ordered)
+    if cls.cache is not None:
+      queries = [{"_id": update["_id"]} if isinstance(update, dict) else update[0] for update in updates]
+      if all(set(query.keys()) == {"_id"} for query in queries):
+        for query in queries:
+          cls.cache.invalidate(query["_id"])
+      else:
+        cls.cache.clear()
+
+    return counts
+
+  async def create_children(self, data, as_, models, indexer = "slug", chunk_size = None, write_policy = None, write_concern = None):
+    # inserts a whole subtree under self along as_: the rows without path are children of self and deeper rows
+    # hang from the row whose url is their path, every level is the children model of as_ of the level above
+    # each level is inserted at once and all the parents get their new entries in a single bulk_write
+    if not self.table:
+      raise InvalidOperation("No table")
+
+    url = self.get_url()
+    rows = [dict(item, path = item.get("path") or url) for item in data]
+    bounds = await self.rank_bounds(as_) if self.ranked(as_) else None
+
+    async def attach(table, session, undo):
+      errors = {}
+      created = []
+      levels = []
+      parents = {url: self}
+      remaining = list(enumerate(rows))
+      parent_class = self.__class__
+      while remaining and as_ in (parent_class.children_models or {}):
+        level = [(index, row) for index, row in remaining if row["path"] in parents]
+        if not level:
+          break
+
+        remaining = [(index, row) for index, row in remaining if row["path"] not in parents]
+        model_class = getattr(models, parent_class.children_models[as_])
+        pending, level_errors = model_class.load_many(table, [row for index, row in level])
+        pending = await self.unique_urls(table, pending, level_errors, session)
+        siblings = {}
+        for position, doc in pending:
+          if parents[doc["path"]].ranked(as_):
+            siblings.setdefault(doc["path"], []).append(doc)
+        for path, docs in siblings.items():
+          # the new nodes have no children yet so their children take the whole rank space
+          for doc, rank in zip(docs, ranks_between(*(bounds if path == url else (None, None)), len(docs))):
+            doc["_rank"] = rank
+
+        checked = set(level_errors)
+        inserted = await model_class.insert_loaded(table, pending, level_errors, chunk_size, session)
+        if inserted.get_data():
+          undo.append(lambda ids = [doc["_id"] for doc in inserted.get_data()]: table.delete_many({"_id": {"$in": ids}}))
+        for position, error in level_errors.items():
+          if session is not None and position not in checked:
+            # a write error (a concurrent insert of the same url) has aborted the transaction
+            raise error
+          errors[level[position][0]] = error
+
+        level_parents = {}
+        for doc in inserted.get_data():
+          node = model_class.spawn(table)
+          node.__data__ = doc
+          level_parents[node.get_url()] = node
+          created.append(doc)
+
+        levels.append((parents, inserted.get_data()))
+        parents = level_parents
+        parent_class = model_class
+
+      for index, row in remaining:
+        errors[index] = {"path": ["Not in the subtree of {} along {}".format(url, as_)]}
+
+      # deepest first so every new node is complete when it's added to its parent
+      aggregates = {}
+      for level_parents, docs in reversed(levels):
+        for doc in docs:
+          parent = level_parents[doc["path"]]
+          if parent is not self and parent.aggregates:
+            own = aggregates.get(node_url(doc)) or {}
+            total = aggregates.setdefault(doc["path"], {"children": {}, "descendants": 0, "sums": dict.fromkeys(parent.aggregate_sums, 0)})
+            total["children"][as_] = total["children"].get(as_, 0) + 1
+            total["descendants"] += 1 + own.get("descendants", 0)
+            for field in parent.aggregate_sums:
+              total["sums"][field] += (doc.get(field) or 0) + (own.get("sums") or {}).get(field, 0)
+
+      requests = []
+      values = []
+      for level_parents, docs in levels:
+        entries = {}
+        for doc in docs:
+          parent = level_parents[doc["path"]]
+          entries.setdefault(doc["path"], [])
+          if as_ in parent.fields:
+            field = "_id" if isinstance(parent.fields[as_].container, ObjectId) else indexer
+            entries[doc["path"]].append(doc[field])
+        for path, entries_ in entries.items():
+          update = {"$push": {as_: {"$each": entries_}}} if entries_ else {}
+          if path != url and path in aggregates:
+            update["$set"] = {"_aggregates": aggregates[path]}
+          if update:
+            requests.append(UpdateOne({"_id": level_parents[path]._id}, update))
+          if path == url:
+            values = entries_
+
+      if requests:
+        await table.bulk_write(requests, session = session)
+        undo.append(lambda: table.update_one({"_id": self._id}, {"$pullAll": {as_: values}}))
+
+      direct = [dict(doc, _aggregates = aggregates.get(node_url(doc)) or {}) for doc in (levels[0][1] if levels else [])]
+      inc = self.aggregate_delta(direct) if self.aggregates and direct else None
+      if inc:
+        await self.bind(table).propagate_aggregates(inc, {as_: len(direct)}, session, local = False)
+
+      return created, errors, values, inc, len(direct)
+
+    # the data of self only changes once the writes are done, a transaction can run attach more than once
+    created, errors, values, inc, count = await self.mutate(attach, write_policy, write_concern)
+    if values:
+      self.get_data().setdefault(as_, []).extend(values)
+    if inc:
+      self.aggregate_locally(inc, {as_: count})
+    self.uncache()
+
+    children = getattr(models, self.children_models[as_]).spawn(self.table, many = True)
+    children.__data__ = created
+    return children, errors
+
+  async def unique_urls(self, table, pending, errors, session = None):
+    # the (position, document) pairs whose url isn't taken by an earlier one nor by an existing node, the rest go to errors
+    urls = {}
+    for position, doc in pending:
+      if node_url(doc) in urls:
+        errors[position] = URIAlreadyExists(node_url(doc))
+      else:
+        urls[node_url(doc)] = position
+
+    slugs = {}
+    for position, doc in pending:
+      if position not in errors:
+        slugs.setdefault(doc["path"], []).append(doc["slug"])
+    if slugs:
+      async for doc in table.find({"$or": [{"path": path, "slug": {"$in": values}} for path, values in slugs.items()]}, {"path": 1, "slug": 1}, session = session):
+        errors[urls[node_url(doc)]] = URIAlreadyExists(node_url(doc))
+
+    return [(position, doc) for position, doc in pending if position not in errors]
+
+  def uncache(self, subtree = False):
+    if self.cache is not None:
+      self.cache.invalidate(self.get_data().get("_id"), self.get_data().get("path"), self.get_data().get("slug"))
+      if subtree:
+        self.cache.invalidate_subtree(self.get_url())
+
+  async def get(self, **kwargs):
+    if self.cache is not None and not kwargs.get("many"):
+      query = kwargs["query"] if "query" in kwargs else {key: value for key, value in kwargs.items() if key not in self.read_options}
+      if set(query.keys()) == {"_id"}:
+        doc = self.cache.get(query["_id"])
+      elif set(query.keys()) == {"path", "slug"}:
+        doc = self.cache.get_path(query["path"], query["slug"])
+      else:
+        doc = None
+
+      if doc:
+        self.read(doc, trusted = kwargs.get("trusted"), lazy = kwargs.get("lazy", False))
+        return
+
+    await super().get(**kwargs)
+
+  async def remove_field(self, field):
+    await super().remove_field(field)
+    self.uncache()
+
+  async def ensure_indexes(self):
+    if not self.table:
+      raise InvalidOperation("No table")
+
+    await self.table.create_index([("path", ASCENDING), ("slug", ASCENDING)], unique = True)
+    await self.table.create_index([("path", ASCENDING), ("type", ASCENDING)])
+    if self.order_strategy == "rank":
+      await self.table.create_index([("path", ASCENDING), ("type", ASCENDING), ("_rank", ASCENDING)])
+
+  def ancestor_levels(self):
+    # one {path, slug} pair per ancestor, from the parent up to the root ({"path": ""})
+    purePath = PurePath(self.path)
+    levels = []
+    while purePath.name != '':
+      levels.append({"path": str(purePath.parent), "slug": purePath.name})
+      purePath = purePath.parent
+
+    levels.append({"path": ""})
+    return levels
+
+  async def ancestors(self, models, parent = False, check = None, projection = None, cached = True, trusted = None, read_preference = None, read_concern = None, session = None):
     if not self.table:
       raise InvalidOperation("No table")
 
     if models is None:
       raise InvalidOperation("No models")
 
-    purePath = PurePath(self.path)
+    # the ancestors' models are only known once fetched so, by default, they come complete
+    if projection:
+      projection = dict.fromkeys(projection, 1) if isinstance(projection, (list, tuple)) else dict(projection)
+      projection.update({"path": 1, "slug": 1, "type": 1})
+
+    levels = self.ancestor_levels()
+    docs = {}
+    if cached and self.cache is not None:
+      for level in levels:
+        doc = self.cache.get_path(level["path"], level.get("slug"))
+        if doc:
+          docs[(level["path"], level.get("slug"))] = doc
+
+    missing = [level for level in levels if (level["path"], level.get("slug")) not in docs]
+    if missing:
+      async for doc in self.reader(read_preference, read_concern).find({"$or": missing}, projection, session = session):
+        docs.setdefault((doc["path"], doc.get("slug") if doc["path"] else None), doc)
+        if self.cache is not None and not projection:
+          self.cache.put(doc)
+
     elements = []
-    while purePath.name != '':
-      doc = await self.table.find_one({"path": str(purePath.parent), "slug": purePath.name})
+    for level in levels[:-1]:
+      doc = docs.get((level["path"], level["slug"]))
       if doc:
-        model = getattr(models, doc["type"])(self.table)
-        model.load(doc)
+        model = getattr(models, doc["type"]).spawn(self.table)
+        model.read(doc, trusted = trusted)
         if not model.get_errors():
           if parent:
             if check is None or check(model):
@@ -191,12 +803,10 @@ class MongoTree(MongoSchema, Tree):
           else:
             elements.append(model)
 
-      purePath = purePath.parent
-
-    doc = await self.table.find_one({"path": ""})
+    doc = docs.get(("", None))
     if doc:
-      model = getattr(models, doc["type"])(self.table)
-      model.load(doc)
+      model = getattr(models, doc["type"]).spawn(self.table)
+      model.read(doc, trusted = trusted)
       if not model.get_errors():
         if parent or (check is not None and check(model)):
           return model
@@ -206,32 +816,403 @@ class MongoTree(MongoSchema, Tree):
     elements.reverse()
     return elements
 
-  async def create_child(self, child, as_, indexer = "slug"):
+  async def descendants(self, models, max_depth = None, types = None, nested = False, projection = None, trusted = None, read_preference = None, read_concern = None):
+    # the whole subtree (max_depth levels of it) with a single query, each node loaded with its own model
+    # nested: [{"node": model, "children": [...]}, ...] for the children of self instead of a flat list
+    if not self.table:
+      raise InvalidOperation("No table")
+
+    if models is None:
+      raise InvalidOperation("No models")
+
+    url = self.get_url()
+    query = subtree_query(url, max_depth)
+    if types:
+      query = {"$and": [query, {"type": {"$in": list(types)}}]}
+    if projection:
+      projection = dict.fromkeys(projection, 1) if isinstance(projection, (list, tuple)) else dict(projection)
+      projection.update({"path": 1, "slug": 1, "type": 1})
+
+    nodes = []
+    async for doc in self.reader(read_preference, read_concern).find(query, projection).sort([("path", ASCENDING), ("_id", ASCENDING)]):
+      model = getattr(models, doc.get("type", self.__class__.__name__)).spawn(self.table)
+      model.read(doc, trusted = trusted)
+      if not model.get_errors():
+        nodes.append(model)
+
+    if not nested:
+      return nodes
+
+    # one pass keyed by url, nodes whose parent was filtered out hang from their closest loaded ancestor
+    entries = {url: {"node": self, "children": []}}
+    for node in nodes:
+      entries[node.get_url()] = {"node": node, "children": []}
+
+    for node in nodes:
+      path = node.path
+      while path not in entries:
+        path = path.rsplit("/", 1)[0] or "/"
+      entries[path]["children"].append(entries[node.get_url()])
+
+    return entries[url]["children"]
+
+  async def rewrite_paths(self, url, new_url, batch_size = None, session = None):
+    batch_size = batch_size or self.bulk_size
+    modified = 0
+    requests = []
+    async for child in self.table.find(subtree_query(url), {"path": 1}, session = session):
+      path = "{}{}".format(new_url, child["path"][len(url):])
+      requests.append(UpdateOne({"_id": child["_id"]}, {"$set": {"path": path}}))
+      if len(requests) >= batch_size:
+        result = await self.table.bulk_write(requests, ordered = False, session = session)
+        modified += result.modified_count
+        requests = []
+
+    if requests:
+      result = await self.table.bulk_write(requests, ordered = False, session = session)
+      modified += result.modified_count
+
+    return modified
+
+  def child_index(self, child, member, indexer = "slug"):
+    # what self keeps in member to reference child
+    return getattr(child, "_id" if isinstance(self.fields[member].container, ObjectId) else indexer)
+
+  async def index_child(self, child, as_, indexer = "slug", position = None, session = None, local = True):
+    # $push only sends the new entry so concurrent inserts don't overwrite each other
+    # local = False leaves the data of self as it is (for writes that can be retried or reverted)
+    value = self.child_index(child, as_, indexer)
+    push = {"$each": [value]}
+    if position is not None:
+      push["$position"] = position
+
+    await self.table.update_one({"_id": self._id}, {"$push": {as_: push}}, session = session)
+
+    if local:
+      self.index_locally(as_, value, position)
+
+  def index_locally(self, member, value, position = None):
+    items = self.get_data().setdefault(member, [])
+    if position is None:
+      items.append(value)
+    else:
+      items.insert(position, value)
+
+  async def unindex_child(self, child, session = None, local = True):
+    pull = {member: self.child_index(child, member) for member in self.children_of_type(child.__class__.__name__)}
+    if pull:
+      await self.table.update_one({"_id": self._id}, {"$pull": pull}, session = session)
+      for member, value in pull.items() if local else ():
+        items = self.get_data().get(member)
+        if items and value in items:
+          items.remove(value)
+
+  async def reindex_child(self, child, slug, session = None):
+    # renames the slug entries of child in place, the _id indexed members don't change
+    members = [member for member in self.children_of_type(child.__class__.__name__) if member in self.get_data() and not isinstance(self.fields[member].container, ObjectId)]
+    if members:
+      await self.table.update_one(
+        {"_id": self._id},
+        {"$set": {"{}.$[old]".format(member): slug for member in members}},
+        array_filters = [{"old": child.slug}],
+        session = session
+      )
+      for member in members:
+        items = self.get_data()[member]
+        if child.slug in items:
+          items[items.index(child.slug)] = slug
+
+  def child_positions(self, child):
+    positions = {}
+    for member in self.children_of_type(child.__class__.__name__):
+      items = self.get_data().get(member) or []
+      if self.child_index(child, member) in items:
+        positions[member] = items.index(self.child_index(child, member))
+
+    return positions
+
+  async def restore_child(self, child, positions):
+    # indexes child back where child_positions found it
+    for member, position in positions.items():
+      await self.index_child(child, member, position = position)
+
+  def get_aggregates(self):
+    stored = self.get_data().get("_aggregates") or {}
+    return {
+      "children": dict(stored.get("children") or {}),
+      "descendants": stored.get("descendants", 0),
+      "sums": {field: (stored.get("sums") or {}).get(field, 0) for field in self.aggregate_sums}
+    }
+
+  def aggregate_delta(self, docs, sign = 1):
+    # what docs, with their own subtrees, add to (or take from) the aggregates of their ancestors
+    inc = {"_aggregates.descendants": 0}
+    inc.update({"_aggregates.sums.{}".format(field): 0 for field in self.aggregate_sums})
+    for doc in docs:
+      stored = doc.get("_aggregates") or {}
+      inc["_aggregates.descendants"] += sign * (1 + stored.get("descendants", 0))
+      for field in self.aggregate_sums:
+        inc["_aggregates.sums.{}".format(field)] += sign * ((doc.get(field) or 0) + (stored.get("sums") or {}).get(field, 0))
+
+    return inc
+
+  def child_members(self, child):
+    # the members of self child is counted in
+    members = self.children_of_type(child.__class__.__name__)
+    indexed = [member for member in members if member in self.fields and self.child_index(child, member) in (self.get_data().get(member) or ())]
+    return indexed or (members if len(members) == 1 else [])
+
+  async def propagate_aggregates(self, inc, children = None, session = None, local = True):
+    # adds inc to self and all its ancestors and children (member -> count) to the children counts of self
+    inc = dict(inc)
+    levels = [] if self.path == "" else self.ancestor_levels()
+    requests = [UpdateMany({"$or": levels}, {"$inc": inc})] if levels else []
+    counts = {"_aggregates.children.{}".format(member): count for member, count in (children or {}).items()}
+    requests.append(UpdateOne({"_id": self._id}, {"$inc": dict(inc, **counts)}))
+    await self.table.bulk_write(requests, ordered = False, session = session)
+
+    if local:
+      self.aggregate_locally(inc, children)
+
+    self.uncache()
+    if self.cache is not None:
+      for level in levels:
+        self.cache.invalidate(path = level["path"], slug = level.get("slug"))
+
+  def aggregate_locally(self, inc, children = None):
+    counts = {"_aggregates.children.{}".format(member): count for member, count in (children or {}).items()}
+    aggregates = self.get_data().setdefault("_aggregates", {})
+    for path, value in dict(inc, **counts).items():
+      keys = path.split(".")[1:]
+      target = aggregates
+      for key in keys[:-1]:
+        target = target.setdefault(key, {})
+      target[keys[-1]] = target.get(keys[-1], 0) + value
+
+  async def repair_aggregates(self, models):
+    # recomputes the aggregates of self and its whole subtree (from the root for the whole tree) in one pass
+    if not self.table:
+      raise InvalidOperation("No table")
+
+    url = self.get_url()
+    docs = {url: await self.table.find_one({"_id": self._id})}
+    async for doc in self.table.find(subtree_query(url)):
+      docs[node_url(doc)] = doc
+
+    aggregates = {node: {"children": {}, "descendants": 0, "sums": dict.fromkeys(self.aggregate_sums, 0)} for node in docs}
+    levels = {}
+    indexes = {}
+    for node, doc in docs.items():
+      parent = docs.get(doc["path"]) if node != url else None
+      levels.setdefault(node.count("/") if node != "/" else 0, []).append((node, parent))
+      if parent is None:
+        continue
+
+      model = getattr(models, parent["type"]) if parent.get("type") else self.__class__
+      members = [member for member, type_ in (model.children_models or {}).items() if type_ == doc.get("type", type_)]
+      counted = []
+      for member in members:
+        if (parent["_id"], member) not in indexes:
+          indexes[(parent["_id"], member)] = set(parent.get(member) or ())
+        if doc["_id"] in indexes[(parent["_id"], member)] or doc.get("slug") in indexes[(parent["_id"], member)]:
+          counted.append(member)
+
+      children = aggregates[node_url(parent)]["children"]
+      for member in counted or (members if len(members) == 1 and doc.get("type") else []):
+        children[member] = children.get(member, 0) + 1
+
+    # deepest first so every node is complete when it's added to its parent
+    for depth in sorted(levels, reverse = True):
+      for node, parent in levels[depth]:
+        if parent is not None:
+          own = aggregates[node]
+          total = aggregates[node_url(parent)]
+          total["descendants"] += 1 + own["descendants"]
+          for field in self.aggregate_sums:
+            total["sums"][field] += (docs[node].get(field) or 0) + own["sums"][field]
+
+    modified = 0
+    requests = [UpdateOne({"_id": docs[node]["_id"]}, {"$set": {"_aggregates": aggregate}}) for node, aggregate in aggregates.items()]
+    for start in range(0, len(requests), self.bulk_size):
+      result = await self.table.bulk_write(requests[start:start + self.bulk_size], ordered = False)
+      modified += result.modified_count
+
+    self.get_data()["_aggregates"] = aggregates[url]
+    self.uncache(True)
+    return modified
+
+  def write_concern_of(self, write_concern = None):
+    concern = self.write_concern if write_concern is None else write_concern
+    if concern is None or isinstance(concern, WriteConcern):
+      return concern
+
+    return WriteConcern(**concern)
+
+  def writer(self, write_concern = None):
+    concern = self.write_concern_of(write_concern)
+    return self.table.with_options(write_concern = concern) if concern is not None else self.table
+
+  def bind(self, table):
+    # self writing through table (its collection with other options) and sharing its data
+    if table is self.table:
+      return self
+
+    node = self.spawn(table)
+    node.__data__ = self.get_data()
+    return node
+
+  async def mutate(self, operation, write_policy = None, write_concern = None):
+    # runs operation(table, session, undo) following the write policy, undo collects the steps that revert what it has written
+    policy = write_policy or self.write_policy
+    if policy not in WRITE_POLICIES:
+      raise InvalidOperation("Unknown write policy: {}".format(policy))
+
+    if policy == "transaction":
+      async with await self.table.database.client.start_session() as session:
+        return await session.with_transaction(lambda session: operation(self.table, session, []), write_concern = self.write_concern_of(write_concern))
+
+    undo = []
+    try:
+      return await operation(self.writer(write_concern), None, undo)
+    except Exception:
+      if policy == "bulk":
+        for step in reversed(undo):
+          try:
+            await step()
+          except PyMongoError:
+            pass
+      raise
+
+  async def create_child(self, child, as_, indexer = "slug", position = None, write_policy = None, write_concern = None):
     if not self.table:
       raise InvalidOperation("No table")
 
     if child.__class__.__name__ == self.children_models[as_]:
       child.table = self.table
-      # start transaction
-      async with await self.table.database.client.start_session() as s:
-        async with s.start_transaction():
-          await child.create()
-          items = getattr(self, as_, None)
-          if items is not None:
-            items.append(getattr(child, "_id" if isinstance(self.fields[as_].container, ObjectId) else indexer))
-            query = {}
-            query[as_] = items
-            await self.table.update_one({"_id": self._id}, {"$set": query})
-      # end transaction
+      # only the parent ranks its children
+      child.get_data().pop("_rank", None)
+      if self.ranked(as_):
+        child.get_data()["_rank"] = rank_between(*await self.rank_bounds(as_, position))
+
+      # the delta of a new node is itself and its own sums, never the _aggregates it was loaded with
+      child.get_data().pop("_aggregates", None)
+      inc = self.aggregate_delta([child.get_data()]) if self.aggregates else None
+
+      async def create(table, session, undo):
+        parent = self.bind(table)
+        node = child.bind(table)
+        await node.create(session)
+        undo.append(lambda: table.delete_one({"_id": node._id}))
+        if as_ in self.fields:
+          await parent.index_child(node, as_, indexer, position, session, local = False)
+          undo.append(lambda: parent.unindex_child(node, local = False))
+        if self.aggregates:
+          await parent.propagate_aggregates(inc, {as_: 1}, session, local = False)
+
+      # the data of self only changes once the writes are done, a transaction can run create more than once
+      await self.mutate(create, write_policy, write_concern)
+      if as_ in self.fields:
+        self.index_locally(as_, self.child_index(child, as_, indexer), position)
+      if self.aggregates:
+        self.aggregate_locally(inc, {as_: 1})
+      self.uncache()
       return child.to_plain_dict()
     else:
       ValidationError("Unexpected child model: {} vs {}".format(child, self.children_models[as_]))
 
-  async def children(self, member, models, sort = None, extra_match = None):
+  def ranked(self, member):
+    # the _id indexed members can reference nodes anywhere in the tree so they always follow their array
+    return self.order_strategy == "rank" and isinstance(member, str) and not (member in self.fields and isinstance(self.fields[member].container, ObjectId))
+
+  def order_key(self, member):
+    if not isinstance(member, str):
+      return "_id"
+
+    return "_rank" if self.ranked(member) else "__order"
+
+  async def rank_bounds(self, member, position = None, exclude = None):
+    # the ranks a child placed at position of member (the end when None) goes between
+    query = {"path": self.get_url(), "type": self.children_models[member], "_rank": {"$exists": True}}
+    if exclude is not None:
+      query["_id"] = {"$ne": exclude}
+
+    if position == 0:
+      first = await self.table.find(query, {"_rank": 1}).sort("_rank", ASCENDING).limit(1).to_list(1)
+      return None, first[0]["_rank"] if first else None
+
+    if position is not None:
+      around = await self.table.find(query, {"_rank": 1}).sort("_rank", ASCENDING).skip(position - 1).limit(2).to_list(2)
+      if around:
+        return around[0]["_rank"], around[1]["_rank"] if len(around) > 1 else None
+
+    last = await self.table.find(query, {"_rank": 1}).sort("_rank", DESCENDING).limit(1).to_list(1)
+    return last[0]["_rank"] if last else None, None
+
+  async def reorder(self, child, as_, position):
+    # moves child to position among the children of as_, with ranks only child is written
+    if not self.table:
+      raise InvalidOperation("No table")
+
+    if self.ranked(as_):
+      rank = rank_between(*await self.rank_bounds(as_, position, child._id))
+      await self.table.update_one({"_id": child._id}, {"$set": {"_rank": rank}})
+      child.get_data()["_rank"] = rank
+      child.uncache()
+    else:
+      value = self.child_index(child, as_)
+      await self.table.update_one({"_id": self._id}, {"$pull": {as_: value}})
+      items = self.get_data().get(as_) or []
+      if value in items:
+        items.remove(value)
+      await self.index_child(child, as_, position = position)
+      self.uncache()
+
+  async def migrate_order(self, models, batch_size = None):
+    # ranks the children of self and its whole subtree following their parents' member arrays
+    # the children missing from the arrays go after them in creation order
     if not self.table:
       raise InvalidOperation("No table")
 
-    if isinstance(member, str):
+    url = self.get_url()
+    parents = [await self.table.find_one({"_id": self._id})]
+    siblings = {}
+    async for doc in self.table.find(subtree_query(url)):
+      parents.append(doc)
+      siblings.setdefault((doc["path"], doc.get("type")), []).append(doc)
+
+    requests = []
+    for parent in parents:
+      model = getattr(models, parent["type"]) if parent.get("type") else self.__class__
+      node = model.spawn(self.table)
+      node.__data__ = parent
+      for member, type_ in (model.children_models or {}).items():
+        if not node.ranked(member):
+          continue
+
+        docs = siblings.pop((node.get_url(), type_), [])
+        order = {slug: index for index, slug in enumerate(parent.get(member) or ())}
+        docs.sort(key = lambda doc: (order.get(doc.get("slug"), len(order)), doc["_id"]))
+        for doc, rank in zip(docs, ranks_between(None, None, len(docs))):
+          requests.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"_rank": rank}}))
+
+    batch_size = batch_size or self.bulk_size
+    modified = 0
+    for start in range(0, len(requests), batch_size):
+      result = await self.table.bulk_write(requests[start:start + batch_size], ordered = False)
+      modified += result.modified_count
+
+    self.uncache(True)
+    return modified
+
+  def children_aggregation(self, member, sort = None, extra_match = None):
+    if self.ranked(member):
+      type_ = self.children_models[member]
+      match = {"$match": {"path": self.get_url(), "type": type_}}
+      if extra_match:
+        match["$match"].update(extra_match)
+
+      aggregation = [match, sort or {"$sort": {"_rank": 1, "_id": 1}}]
+    elif isinstance(member, str):
       type_ = self.children_models[member]
       if not sort:
         sort = {"$sort": {"__order": 1}}
@@ -252,89 +1233,244 @@ class MongoTree(MongoSchema, Tree):
       if sort:
         aggregation.append(sort)
 
-    docs = await self.table.aggregate(aggregation).to_list(None)
+    return type_, aggregation
 
+  async def children(self, member, models, sort = None, extra_match = None, projection = None, trusted = None, compact = False, read_preference = None, read_concern = None):
+    if not self.table:
+      raise InvalidOperation("No table")
+
+    type_, aggregation = self.children_aggregation(member, sort, extra_match)
     model_class = getattr(models, type_)
-    children = model_class(self.table, many = True)
-    children.load(docs, many = True)
+    projection = model_class.spawn(self.table).resolve_projection(projection)
+    if projection:
+      aggregation.append({"$project": projection})
+
+    docs = await self.reader(read_preference, read_concern).aggregate(aggregation).to_list(None)
+
+    children = model_class.spawn(self.table, many = True)
+    children.read(docs, True, trusted, compact = compact)
 
     return children
 
-  async def update(self, data, models = None):
+  async def children_page(self, member, models, limit = None, after = None, sort = None, extra_match = None, projection = None, trusted = None, compact = False, read_preference = None, read_concern = None):
     if not self.table:
       raise InvalidOperation("No table")
 
-    # Start mongo transaction
-    async with await self.table.database.client.start_session() as s:
-      async with s.start_transaction():
-        if "slug" in data and data["slug"] and self.slug != data["slug"]:
-          # update parent
-          parent = await self.ancestors(models, True)
-          # look_at is the list of members of self of type model_name (everyone where I can put of this type)
-          look_at = parent.children_of_type(self.__class__.__name__)
-
-          if look_at:
-            # search on them to see if self is there and annotate to update the new slug
-            to_set = {}
-            for child in look_at:
-              try:
-                orig = getattr(parent, child)
-                # if self is not indexed in this parent's member it will crash with ValueError (which is ok cause we only care when it's found)
-                # when we put _id instead of slug we don't need to update the index so its ok too that will crash
-                index = orig.index(self.slug)
-                orig[index] = data["slug"]
-                to_set[child] = orig
-              except ValueError:
-                pass
-
-            if to_set:
-              await parent.table.update_one({"_id": parent._id}, {"$set": to_set})
-
-          # update children
-          url = self.get_url()
-          new_url = "{}/{}".format(("" if self.path == "/" else self.path), data["slug"])
-          async for child in self.table.find({"path": {"$regex": "^{}".format(url)}}):
-            path = child["path"].replace(url, new_url)
-            # TODO: can we bulk this, please?
-            await self.table.update_one({"_id": child["_id"]}, {"$set": {"path": path}})
-
-        # update itself
-        model = await super().update(data)
+    key, direction = page_order(sort, (self.order_key(member), ASCENDING))
+    limit = limit or self.page_size
+    type_, aggregation = self.children_aggregation(member, {"$sort": {key: direction, "_id": direction}}, extra_match)
+    if after:
+      aggregation.insert(-1, {"$match": keyset_query(after, key, direction)})
+    aggregation.append({"$limit": limit + 1})
 
-    return model
+    model_class = getattr(models, type_)
+    projection = model_class.spawn(self.table).resolve_projection(projection)
+    if projection:
+      aggregation.append({"$project": dict(projection, **{key: 1})})
+
+    docs = await self.reader(read_preference, read_concern).aggregate(aggregation).to_list(None)
+
+    children = model_class.spawn(self.table, many = True)
+    children.read(docs[:limit], True, trusted, compact = compact)
 
-  async def delete(self, models = None):
+    return children, page_token(key, docs[limit - 1]) if len(docs) > limit else None
+
+  async def load_context(self, models, members = None, sort = None, projection = None, trusted = None, compact = False, read_preference = None, read_concern = None):
+    # the ancestors and the children of every member (all of children_models by default) with concurrent queries
     if not self.table:
       raise InvalidOperation("No table")
 
-    path = self.get_url()
-    async with await self.table.database.client.start_session() as s:
-      async with s.start_transaction():
-        # start transaction
+    members = list(self.children_models.keys()) if members is None else list(members)
+    options = {"trusted": trusted, "read_preference": read_preference, "read_concern": read_concern}
+    queries = [self.children(member, models, sort, projection = projection, compact = compact, **options) for member in members]
+    # the root has no ancestors
+    if self.path != "":
+      queries.append(self.ancestors(models, **options))
+
+    results = await gather(*queries)
+    ancestors = results[len(members)] if self.path != "" else []
+    return {
+      "ancestors": ancestors,
+      "parent": ancestors[-1] if ancestors else None,
+      "children": dict(zip(members, results))
+    }
+
+  async def stream_children(self, member, models, sort = None, extra_match = None, batch_size = None, projection = None, trusted = None, read_preference = None, read_concern = None):
+    if not self.table:
+      raise InvalidOperation("No table")
+
+    batch_size = batch_size or self.stream_batch_size
+    type_, aggregation = self.children_aggregation(member, sort, extra_match)
+    model_class = getattr(models, type_)
+    projection = model_class.spawn(self.table).resolve_projection(projection)
+    if projection:
+      aggregation.append({"$project": projection})
+
+    cursor = self.reader(read_preference, read_concern).aggregate(aggregation, batchSize = batch_size)
+    async for batch in self.batches(cursor, model_class, batch_size, trusted):
+      yield batch
+
+  async def update(self, data, models = None, batch_size = None, write_policy = None, write_concern = None):
+    if not self.table:
+      raise InvalidOperation("No table")
+
+    if "_id" not in self.get_data():
+      raise InvalidOperation("The object hasn't been saved {}".format(self.get_data()))
+
+    # the aggregates are only changed through $inc and the ranks through reorder and move
+    data = {key: value for key, value in data.items() if key not in ("_aggregates", "_rank")}
+    url = self.get_url()
+
+    # validated before anything is written, the sums and the document get the loaded values
+    model = self.spawn(self.table, only = tuple(data.keys()))
+    model.load(data)
+    errors = model.get_errors()
+    if errors:
+      raise ValidationError(errors)
+
+    loaded = model.get_data()
+    data = {key: loaded.get(key, value) for key, value in data.items() if key != "_id"}
+    sums = {"_aggregates.sums.{}".format(field): (data[field] or 0) - (self.get_data().get(field) or 0) for field in self.aggregate_sums if field in data}
+
+    rename = bool(data.get("slug")) and data["slug"] != self.slug
+    new_url = "{}/{}".format(("" if self.path == "/" else self.path), data["slug"]) if rename else url
+    previous = {key: self.get_data()[key] for key in data if key in self.get_data()}
+
+    async def update(table, session, undo):
+      node = self.bind(table)
+      rewritten = 0
+      # update itself first, the unique path+slug index refuses a rename onto an existing slug before anything else changes
+      try:
+        await table.update_one({"_id": self._id}, {"$set": data}, session = session)
+      except DuplicateKeyError:
+        raise URIAlreadyExists(new_url)
+      undo.append(lambda: table.update_one({"_id": self._id}, restoring(previous, data)))
+
+      if self.aggregates and self.path != "" and any(sums.values()):
+        levels = self.ancestor_levels()
+        await table.update_many({"$or": levels}, {"$inc": sums}, session = session)
+        undo.append(lambda: table.update_many({"$or": levels}, {"$inc": negated(sums)}))
+        if self.cache is not None:
+          for level in levels:
+            self.cache.invalidate(path = level["path"], slug = level.get("slug"))
+
+      if rename:
         # update parent
-        parent = await self.ancestors(models, True)
+        parent = await node.ancestors(models, True, cached = False, read_preference = ReadPreference.PRIMARY, session = session)
         if parent:
-          # look_at is the list of members of self of type model_name (everyone where I can put of this type)
-          look_at = parent.children_of_type(self.__class__.__name__)
-
-          if look_at:
-            # search on them to see if self is there and annotate to update the new slug
-            to_set = {}
-            for child in look_at:
-              try:
-                orig = getattr(parent, child)
-                # if self is not indexed in this parent's member it will crash with ValueError (which is ok cause we only care when it's found)
-                # when we put _id instead of slug we don't need to update the index so its ok too that will crash
-                index = orig.index(self.slug)
-                orig.pop(index)
-                to_set[child] = orig
-              except ValueError:
-                pass
-
-            if to_set:
-              await parent.table.update_one({"_id": parent._id}, {"$set": to_set})
-        # delete children
-        await self.table.delete_many({"path": {"$regex": "^{}".format(path)}})
-        # delete itself
-        await super().delete()
-        # end transaction
+          await parent.reindex_child(node, data["slug"], session)
+          renamed = self.spawn(table)
+          renamed.__data__ = dict(self.get_data(), slug = data["slug"])
+          undo.append(lambda: parent.reindex_child(renamed, self.slug))
+          parent.uncache()
+
+        # update children
+        rewritten = await node.rewrite_paths(url, new_url, batch_size, session)
+        undo.append(lambda: node.rewrite_paths(new_url, url, batch_size))
+
+      return rewritten
+
+    rewritten = await self.mutate(update, write_policy, write_concern)
+    self.uncache(rename)
+    self.__data__.update(data)
+    # how many descendants got their path rewritten by a rename
+    model.rewritten = rewritten
+    return model
+
+  async def move(self, new_parent, as_, models = None, indexer = "slug", position = None, batch_size = None, write_policy = None, write_concern = None):
+    if not self.table:
+      raise InvalidOperation("No table")
+
+    if self.path == "":
+      raise InvalidOperation("The root can't be moved")
+
+    if self.__class__.__name__ != new_parent.children_models.get(as_):
+      raise ValidationError("Unexpected child model: {} vs {}".format(self.__class__.__name__, new_parent.children_models.get(as_)))
+
+    url = self.get_url()
+    parent_url = new_parent.get_url()
+    if parent_url == url or parent_url.startswith(url + "/"):
+      raise InvalidOperation("{} can't be moved into its own subtree ({})".format(url, parent_url))
+
+    new_url = "{}/{}".format("" if parent_url == "/" else parent_url, self.slug)
+    moved = {"path": parent_url}
+    if new_parent.ranked(as_):
+      moved["_rank"] = rank_between(*await new_parent.rank_bounds(as_, position, self._id))
+    previous = {key: self.get_data()[key] for key in moved if key in self.get_data()}
+    self.uncache(True)
+
+    async def move(table, session, undo):
+      node = self.bind(table)
+      target = new_parent.bind(table)
+      parent = await node.ancestors(models, True, cached = False, read_preference = ReadPreference.PRIMARY, session = session)
+      current = await table.find_one({"_id": self._id}, dict.fromkeys(("_aggregates", ) + tuple(self.aggregate_sums), 1), session = session) if self.aggregates else None
+
+      # move itself, the unique path+slug index refuses the move if the new parent already has this slug
+      try:
+        await table.update_one({"_id": self._id}, {"$set": moved}, session = session)
+      except DuplicateKeyError:
+        raise URIAlreadyExists(new_url)
+      undo.append(lambda: table.update_one({"_id": self._id}, restoring(previous, moved)))
+
+      # move its descendants
+      await node.rewrite_paths(url, new_url, batch_size, session)
+      undo.append(lambda: node.rewrite_paths(new_url, url, batch_size))
+
+      # detach from the old parent
+      if parent:
+        members = parent.child_members(node)
+        positions = parent.child_positions(node)
+        await parent.unindex_child(node, session)
+        undo.append(lambda: parent.restore_child(node, positions))
+        if parent.aggregates:
+          inc = parent.aggregate_delta([current or self.get_data()], -1)
+          await parent.propagate_aggregates(inc, {member: -1 for member in members}, session)
+          undo.append(lambda: parent.propagate_aggregates(negated(inc), {member: 1 for member in members}))
+        parent.uncache()
+
+      # attach to the new one
+      if as_ in new_parent.fields:
+        await target.index_child(node, as_, indexer, position, session, local = False)
+        undo.append(lambda: target.unindex_child(node, local = False))
+      inc = new_parent.aggregate_delta([current or self.get_data()]) if new_parent.aggregates else None
+      if inc:
+        await target.propagate_aggregates(inc, {as_: 1}, session, local = False)
+      return inc
+
+    # the data of self and new_parent only change once the writes are done, a transaction can run move more than once
+    inc = await self.mutate(move, write_policy, write_concern)
+    self.get_data().update(moved)
+    if as_ in new_parent.fields:
+      new_parent.index_locally(as_, new_parent.child_index(self, as_, indexer), position)
+    if inc:
+      new_parent.aggregate_locally(inc, {as_: 1})
+    new_parent.uncache()
+
+  async def delete(self, models = None, write_policy = None, write_concern = None):
+    if not self.table:
+      raise InvalidOperation("No table")
+
+    path = self.get_url()
+
+    async def delete(table, session, undo):
+      node = self.bind(table)
+      # update parent
+      parent = await node.ancestors(models, True, cached = False, read_preference = ReadPreference.PRIMARY, session = session)
+      if parent:
+        members = parent.child_members(node)
+        positions = parent.child_positions(node)
+        await parent.unindex_child(node, session)
+        undo.append(lambda: parent.restore_child(node, positions))
+        parent.uncache()
+        if parent.aggregates:
+          current = await table.find_one({"_id": self._id}, dict.fromkeys(("_aggregates", ) + tuple(parent.aggregate_sums), 1), session = session)
+          inc = parent.aggregate_delta([current or self.get_data()], -1)
+          await parent.propagate_aggregates(inc, {member: -1 for member in members}, session)
+          undo.append(lambda: parent.propagate_aggregates(negated(inc), {member: 1 for member in members}))
+      # delete children, nothing can be undone from here on
+      await table.delete_many(subtree_query(path), session = session)
+      # delete itself
+      await super(MongoTree, node).delete(session)
+
+    await self.mutate(delete, write_policy, write_concern)
+    self.uncache(True)